@@ -34,12 +34,13 @@ BLOCK_SIZE = 0x100000: the maximum amount of data, in bytes, to read and write
 PAUSED_WAIT = .1: in functions that take a progress function, if the action is
                   paused, the function waits this many seconds between
                   subsequent calls to the progress function.
+COPY_THREADS = 4: the number of files GCFS.extract, GCFS.extract_extra_files and
+                  GCFS.write copy at once.
 
 """
 
 # TODO:
 # - improve error reporting on failure (eg. write to RO FS)
-# - read should use struct.unpack for ints (do some timings)
 # - put code that gets gaps in fs in a function (used twice)
 # - compress should truncate if possible
 # - compile regex in search_tree, and raise ValueError if fails
@@ -63,11 +64,20 @@ PAUSED_WAIT = .1: in functions that take a progress function, if the action is
 # - separate wii/gc classes
 # - wrapper function which returns a wii/gc based on magic word
 
-from sys import byteorder
+from sys import byteorder, intern
 import os
-from os.path import getsize, exists, dirname, basename
+import errno
+from os.path import getsize, dirname, basename
 from time import sleep
-from copy import deepcopy
+from io import BytesIO
+from collections import deque
+from bisect import bisect_left
+from operator import itemgetter
+try:
+    from threading import Lock, local
+except ImportError:
+    from dummy_threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor
 from array import array
 import re
 from shutil import rmtree
@@ -81,11 +91,17 @@ except NameError:
 CODEC = 'shift-jis'
 BLOCK_SIZE = 0x100000
 PAUSED_WAIT = .1
+COPY_THREADS = 4
 
 _decode = lambda b: b.decode(CODEC)
 _encode = lambda s: s.encode(CODEC)
 _decoded = lambda s: _decode(s) if isinstance(s, bytes) else s
+_encoded = lambda s: s if isinstance(s, bytes) else _encode(s)
 _sep = lambda s: _encode(os.sep) if isinstance(s, bytes) else os.sep
+# array typecode for the filesystem table's 4-byte integers: 'I' is usually 4
+# bytes, but only 'L' is guaranteed to be big enough
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+assert array(_U32).itemsize == 4
 
 class Sanity:
     CHECK = 1
@@ -109,14 +125,135 @@ Takes the name to check, which can be str or bytes, and returns whether it is
 valid.  A valid name can be safely added to the tree of a GCFS instance.
 
 """
-    if (b'\0', '\0')[isinstance(name, str)] in name:
-        return False
+    if isinstance(name, str):
+        if '\0' in name:
+            return False
+        try:
+            _encode(name)
+        except UnicodeEncodeError:
+            return False
+    else:
+        if b'\0' in name:
+            return False
+        try:
+            _decode(name)
+        except UnicodeDecodeError:
+            return False
+    return True
+
+
+def _fileno (f):
+    """Get the file descriptor for positional I/O on a file object, or None."""
+    if not hasattr(os, 'preadv'):
+        return None
+    try:
+        return f.fileno()
+    except (AttributeError, OSError, ValueError):
+        # not backed by a real file
+        return None
+
+
+def _pwrite (fd, data, pos):
+    """Write all of the given data to a file descriptor at a position."""
+    # slicing a memoryview doesn't copy what's left after a short write
+    data = memoryview(data)
+    while data:
+        amount = os.pwrite(fd, data, pos)
+        data = data[amount:]
+        pos += amount
+
+
+# errors from copy_file_range meaning the kernel can't copy between two files
+_NO_KERNEL_COPY = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.EBADF)
+
+
+def _copy_range (src_fd, src_pos, dest_fd, dest_pos, amount):
+    """Copy data between file descriptors without reading it into memory.
+
+_copy_range(src_fd, src_pos, dest_fd, dest_pos, amount) -> copied
+
+copied: the amount of data copied; this is less than amount only if the end of
+        the source file is reached.
+
+Raises OSError with an errno in _NO_KERNEL_COPY if the kernel can't copy
+between the given files.
+
+"""
+    copied = 0
+    while copied < amount:
+        done = os.copy_file_range(src_fd, dest_fd, amount - copied,
+                                  src_pos + copied, dest_pos + copied)
+        if not done:
+            # end of source file
+            break
+        copied += done
+    return copied
+
+
+def _moves_independent (moves):
+    """Check whether moves within a file can be made in any order.
+
+Takes a list of (src_start, dest_start, size) tuples, and returns whether no
+move's destination overlaps the source of a different move.
+
+"""
+    srcs = sorted((src, src + size, i) for i, (src, dest, size)
+                  in enumerate(moves) if size)
+    # sources should never overlap each other, but if they do, play safe
+    for (start, end, i), (next_start, next_end, j) in zip(srcs, srcs[1:]):
+        if end > next_start:
+            return False
+    starts = [src[0] for src in srcs]
+    ends = [src[1] for src in srcs]
+    for i, (src, dest, size) in enumerate(moves):
+        if not size:
+            continue
+        # sources that start before this destination ends and end after it
+        # starts
+        first = bisect_left(ends, dest + 1)
+        last = bisect_left(starts, dest + size)
+        if any(srcs[k][2] != i for k in range(first, last)):
+            return False
+    return True
+
+
+def _prepare_copy (f, end):
+    """Prepare a file object for a large copy within or into it.
+
+_prepare_copy(f, end) -> extended
+
+f: file object open in binary read/write mode.
+end: the position the copied data will extend up to.
+
+extended: whether the file will be made larger by the copy.
+
+This tells the OS we'll be accessing the file sequentially and, if the file is
+shorter than end, allocates the extra space all at once, which gives the
+filesystem the chance to keep it contiguous.  If that isn't possible, the file
+is left alone: writing beyond its end extends it anyway, and the final size is
+set once everything has been written.
+
+"""
     try:
-        (_encode if isinstance(name, str) else _decode)(name)
-    except (UnicodeEncodeError, UnicodeDecodeError):
+        fd = f.fileno()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+    if fd is not None and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            # only a hint, and some filesystems refuse it
+            pass
+    size = f.seek(0, 2) if fd is None else os.fstat(fd).st_size
+    if size >= end:
         return False
-    else:
-        return True
+    try:
+        os.posix_fallocate(fd, size, end - size)
+    except (AttributeError, TypeError, OSError):
+        # not supported: the copy extends the file as it goes
+        pass
+    return True
 
 
 def read (f, start, size = None, num = False, until = None, block_size = 0x10):
@@ -179,8 +316,7 @@ Data is always measured in bytes.
                 elif do is not True:
                     raise ValueError('until should only return True or an int')
     if num:
-        size = len(data)
-        data = sum(j * 256 ** (size - i - 1) for i, j in enumerate(data))
+        data = int.from_bytes(data, 'big')
     return data
 
 
@@ -199,21 +335,18 @@ size: if converting from an int, pad it to this size in bytes by prepending by
 """
     if isinstance(data, int):
         # convert to bytes
-        i = data
-        data = []
-        while i:
-            data.insert(0, i % 256)
-            i //= 256
-        data = b'\0' * max(size - len(data), 0) + bytes(data)
+        length = (data.bit_length() + 7) // 8
+        data = data.to_bytes(max(size or 0, length), 'big')
     f.seek(pos)
     f.write(data)
 
 
 def copy (files, progress = None, names = None, overwrite = True,
-          can_cancel = False):
+          can_cancel = False, threads = 1):
     """Copy a file to a file object.
 
-copy(files[, progress, names], overwrite = True, can_cancel = False) -> failed
+copy(files[, progress, names], overwrite = True, can_cancel = False,
+     threads = 1) -> failed
 
 files: a list of (source, *dests) tuples to copy from source to dest.  source
        is (file, start, size) and each dest is (file, start), where, in each
@@ -259,6 +392,10 @@ overwrite: whether to overwrite any destination files that exist (if False and
            given.
 can_cancel: whether cancelling this copy operation (by returning 2 from the
             progress function) is allowed.
+threads: the maximum number of elements of files to copy at the same time.  If
+         this is more than 1, a file object may only be used in more than one
+         element of files if it is backed by a file descriptor, and the
+         platform supports positional reads and writes (os.preadv).
 
 failed: a list of indices in the given files list for copies that failed.  Or,
         if this function is cancelled (see the progress and can_cancel
@@ -313,14 +450,41 @@ failed: a list of indices in the given files list for copies that failed.  Or,
             names.append(f)
     # actual copy
     failed = []
-    total_done = 0
-    progress_update = BLOCK_SIZE
-    for file_i, (src, *dests) in enumerate(to_copy):
+    # progress and cancel state shared between copying threads
+    lock = Lock()
+    state = {'done': 0, 'update': BLOCK_SIZE, 'cancelled': None}
+    # each thread reuses one buffer for every file it copies
+    bufs = local()
+
+    def check_progress (file_i):
+        # call the progress function if it's due; returns the value used to
+        # cancel, if any
+        with lock:
+            if (state['cancelled'] is None and progress is not None and
+                state['done'] >= state['update']):
+                # update progress
+                result = progress(state['done'], total_size, names[file_i])
+                while result == 1:
+                    # paused
+                    sleep(PAUSED_WAIT)
+                    result = progress(None, None, None)
+                if result == 3:
+                    state['cancelled'] = False
+                elif result == 2 and can_cancel:
+                    # cancel
+                    state['cancelled'] = True
+                state['update'] += BLOCK_SIZE
+            return state['cancelled']
+
+    def copy_file (file_i, src, dests):
+        if state['cancelled'] is not None:
+            return
         src_f, src_start, size = src
         src_open = isinstance(src_f, string)
         dest_fs = []
         dest_starts = []
         dest_opens = []
+        fds = []
         for dest in dests:
             dest_f, dest_start = dest
             dest_fs.append(dest_f)
@@ -330,66 +494,147 @@ failed: a list of indices in the given files list for copies that failed.  Or,
             # open files
             if src_open:
                 src_f = open(src_f, 'rb')
-            this_failed = False
             for i, (dest_f, dest_open) in enumerate(zip(dest_fs, dest_opens)):
                 if dest_open:
-                    if not overwrite and exists(dest_f):
-                        # exists and don't want to overwrite
-                        failed.append(i)
-                        this_failed = True
-                        break
-                    dest_fs[i] = open(dest_f, 'wb')
-            if this_failed:
-                continue
+                    if overwrite:
+                        dest_fs[i] = open(dest_f, 'wb')
+                    else:
+                        # fails if the file exists
+                        flags = (os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                                 getattr(os, 'O_BINARY', 0))
+                        dest_fs[i] = os.fdopen(os.open(dest_f, flags), 'wb')
+            # use positional reads and writes on file descriptors where
+            # possible: this avoids seeking, and means files can be shared
+            # between threads
+            fds = [_fileno(f) for f in [src_f] + dest_fs]
+            for f, fd in zip([src_f] + dest_fs, fds):
+                if fd is not None:
+                    f.flush()
+            src_fd, *dest_fds = fds
             # seek
             sames = []
-            for dest_f in dest_fs:
+            for dest_f, dest_start, dest_fd in zip(dest_fs, dest_starts,
+                                                   dest_fds):
                 same = src_f is dest_f
                 sames.append(same)
-                if not same:
+                if not same and dest_fd is None:
                     dest_f.seek(dest_start)
-            if not any(sames):
+            if not any(sames) and src_fd is None:
                 src_f.seek(src_start)
+            # between real files, let the kernel copy the data
+            # (copy_file_range is positional at both ends, unlike sendfile,
+            # so the image can still be shared between threads); it can't
+            # copy between overlapping parts of the same file
+            kernel = (hasattr(os, 'copy_file_range') and src_fd is not None
+                      and None not in dest_fds and not any(
+                          same and src_start < dest_start + size and
+                          dest_start < src_start + size
+                          for same, dest_start in zip(sames, dest_starts)
+                      ))
+            buf = getattr(bufs, 'buf', None)
+            if buf is None:
+                buf = bufs.buf = memoryview(bytearray(BLOCK_SIZE))
+            readinto = getattr(src_f, 'readinto', None)
             # copy
             done = 0
             while size:
-                if progress is not None and total_done >= progress_update:
-                    # update progress
-                    result = progress(total_done, total_size, names[file_i])
-                    while result == 1:
-                        # paused
-                        sleep(PAUSED_WAIT)
-                        result = progress(None, None, None)
-                    if result == 3:
-                        return False
-                    if result == 2 and can_cancel:
-                        # cancel
-                        return True
-                    progress_update += BLOCK_SIZE
-                # read and write the next block
-                amount = min(size, BLOCK_SIZE)
-                if any(sames):
-                    src_f.seek(src_start + done)
-                data = src_f.read(amount)
-                for dest_f, dest_start, same in zip(dest_fs, dest_starts,
-                                                    sames):
-                    if same:
-                        dest_f.seek(dest_start + done)
-                    dest_f.write(data)
+                if check_progress(file_i) is not None:
+                    return
+                # read and write the next block; if there's no progress to
+                # report, the kernel can copy the whole file in one go
+                if kernel and progress is None:
+                    amount = size
+                else:
+                    amount = min(size, BLOCK_SIZE)
+                if kernel:
+                    try:
+                        got = amount
+                        for dest_fd, dest_start in zip(dest_fds, dest_starts):
+                            got = min(got, _copy_range(
+                                src_fd, src_start + done, dest_fd,
+                                dest_start + done, amount
+                            ))
+                    except OSError as e:
+                        if e.errno not in _NO_KERNEL_COPY:
+                            raise
+                        # fall back to copying through memory
+                        kernel = False
+                        amount = min(size, BLOCK_SIZE)
+                if not kernel:
+                    if src_fd is not None:
+                        data = buf[:os.preadv(src_fd, [buf[:amount]],
+                                              src_start + done)]
+                    else:
+                        if any(sames):
+                            src_f.seek(src_start + done)
+                        if readinto is None:
+                            data = src_f.read(amount)
+                        else:
+                            data = buf[:readinto(buf[:amount])]
+                    for dest_f, dest_start, dest_fd, same in zip(
+                        dest_fs, dest_starts, dest_fds, sames
+                    ):
+                        if dest_fd is not None:
+                            _pwrite(dest_fd, data, dest_start + done)
+                        else:
+                            if same:
+                                dest_f.seek(dest_start + done)
+                            dest_f.write(data)
+                    got = len(data)
                 size -= amount
                 done += amount
-                total_done += amount
+                if got < amount:
+                    # reached the end of the source: count the rest as done
+                    amount += size
+                    size = 0
+                with lock:
+                    state['done'] += amount
+            if (done and src_fd is not None and not any(sames) and
+                hasattr(os, 'posix_fadvise')):
+                # we won't read this data again, so don't let it push more
+                # useful data out of the OS's cache
+                try:
+                    os.posix_fadvise(src_fd, src_start, done,
+                                     os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    pass
         except IOError:
-            failed.append(file_i)
-            continue
+            with lock:
+                failed.append(file_i)
         finally:
             # clean up
-            if src_open and not isinstance(src_f, string):
-                src_f.close()
-            for dest_f, dest_open in zip(dest_fs, dest_opens):
-                if dest_open and not isinstance(dest_f, string):
-                    dest_f.close()
-    return failed
+            for f, fd in zip([src_f] + dest_fs, fds):
+                if fd is not None:
+                    # drop anything buffered before we used the descriptor
+                    f.flush()
+            for f, f_open in zip([src_f] + dest_fs, [src_open] + dest_opens):
+                if f_open and not isinstance(f, string):
+                    f.close()
+
+    # if every file is copied out of the same source (eg. extracting from a
+    # disk image), go through it in order of position; files keep their
+    # indices, so this doesn't affect failed or names
+    order = list(enumerate(to_copy))
+    if to_copy:
+        src_f = to_copy[0][0][0]
+        if all(src[0] == src_f and all(dest[0] != src_f for dest in dests)
+               for src, *dests in to_copy):
+            order.sort(key = lambda f: f[1][0][1])
+    if threads > 1 and len(to_copy) > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            # consume results to propagate exceptions
+            for x in pool.map(lambda args: copy_file(*args),
+                              ((file_i, src, dests) for file_i, (src, *dests)
+                               in order)):
+                pass
+    else:
+        for file_i, (src, *dests) in order:
+            copy_file(file_i, src, dests)
+            if state['cancelled'] is not None:
+                break
+    if state['cancelled'] is not None:
+        return state['cancelled']
+    return sorted(failed)
 
 
 def bnr_to_pnm (img_data):
@@ -458,29 +703,24 @@ This returns a dict in the same format as the tree attribute of GCFS objects.
 That is, you can place it directly in such a tree to import lots of files.
 
 """
-    walk_iter = os.walk(root, followlinks=follow_symlinks)
-
-    def recur ():
-        tree = {}
-        try:
-            path, dirs, files = next(walk_iter)
-        except StopIteration:
-            # seems to indicate a dir we don't have read access to
-            tree[None] = []
-        else:
-            # files
-            tree[None] = [(f, _join(path, f)) for f in files]
-            # dirs
-            for d in dirs:
-                tree[(d, None)] = recur()
-        return tree
-
-    return recur()
+    # trees by path; directories we don't have read access to are never
+    # walked, and so stay empty
+    trees = {root: {None: []}}
+    for path, dirs, files in os.walk(root, followlinks=follow_symlinks):
+        tree = trees[path]
+        # files
+        tree[None] = [(f, _join(path, f)) for f in files]
+        # dirs
+        for d in dirs:
+            tree[(d, None)] = trees[os.path.join(path, d)] = {None: []}
+    return trees[root]
 
 
 def tree_names (tree):
     """Get the top-level names in a tree (including files and directories)."""
-    return [x[0] for x in list(tree.keys()) + tree[None] if x is not None]
+    names = [k[0] for k in tree if k is not None]
+    names += [f[0] for f in tree[None]]
+    return names
 
 
 def _match (term, name, case_sensitive, whole_name, regex):
@@ -543,25 +783,94 @@ matches: a list of (is_dir, parent_path, key) tuples for matching files and
         matches = []
         if not case_sensitive:
             term = term.lower()
-    for d_key, this_tree in tree.items():
-        if d_key is None:
-            # files
-            if files:
-                for f_key in this_tree:
-                    if _match(term, f_key[0], case_sensitive, whole_name,
+    # walk the tree depth-first with an explicit stack of (path, children
+    # iterator)
+    stack = [(current_dir, iter(tree.items()))]
+    while stack:
+        path, children = stack[-1]
+        for d_key, this_tree in children:
+            if d_key is None:
+                # files
+                if files:
+                    for f_key in this_tree:
+                        if _match(term, f_key[0], case_sensitive, whole_name,
+                                  regex):
+                            matches.append((False, path, f_key))
+            else:
+                # dir
+                if dirs:
+                    if _match(term, d_key[0], case_sensitive, whole_name,
                               regex):
-                        matches.append((False, current_dir, f_key))
+                        matches.append((True, path, d_key))
+                # search this dir before carrying on here
+                stack.append((path + [d_key], iter(this_tree.items())))
+                break
         else:
-            # dir
-            if dirs:
-                if _match(term, d_key[0], case_sensitive, whole_name, regex):
-                    matches.append((True, current_dir, d_key))
-            # search this dir (its results get added to matches)
-            search_tree(this_tree, term, case_sensitive, whole_name, regex,
-                        dirs, files, current_dir + [d_key], matches)
+            # finished with this dir
+            stack.pop()
     return matches
 
 
+class _Gaps:
+    """Free space in a disk image, for finding the first large enough gap.
+
+Takes a list of gaps sorted by position, each a (start, size) tuple, which is
+available (and kept up to date) as the gaps attribute.  Sizes are also stored in
+a binary tree laid out in a list like a heap, where each node holds the largest
+size below it, so that finding and changing gaps takes logarithmic time.
+
+"""
+
+    def __init__ (self, gaps):
+        self.gaps = gaps = list(gaps)
+        n = 1
+        while n < len(gaps):
+            n *= 2
+        self._n = n
+        # leaves with no gap have size -1, so never match
+        self._sizes = sizes = [-1] * (2 * n)
+        for i, (start, size) in enumerate(gaps):
+            sizes[n + i] = size
+        for i in range(n - 1, 0, -1):
+            sizes[i] = max(sizes[2 * i], sizes[2 * i + 1])
+
+    def find (self, size, before = None):
+        """Get the index of the first gap at least size bytes long, or -1.
+
+If before is given, also return -1 if that gap doesn't start before this
+position.
+
+"""
+        sizes = self._sizes
+        if sizes[1] < size:
+            return -1
+        # go down the tree, preferring the left (earlier) branch
+        i = 1
+        while i < self._n:
+            i *= 2
+            if sizes[i] < size:
+                i += 1
+        i -= self._n
+        if before is not None and self.gaps[i][0] >= before:
+            return -1
+        return i
+
+    def set (self, i, start, size):
+        """Change the gap at the given index.
+
+The gap must stay in the same place in the position order.  A size of 0 removes
+the gap.
+
+"""
+        self.gaps[i] = (start, size)
+        sizes = self._sizes
+        i += self._n
+        sizes[i] = size if size > 0 else -1
+        while i > 1:
+            i //= 2
+            sizes[i] = max(sizes[2 * i], sizes[2 * i + 1])
+
+
 class GCFS:
     """Read from and make changes to a GameCube image's filesystem.
 
@@ -662,7 +971,7 @@ tree: a dict representing the root directory.  Each directory is a dict whose
                     self.fs_type = FSType.WII
                 else:
                     raise DiskError(_('DVD magic word missing'))
-                end = f.seek(0, 2)
+                end = os.fstat(f.fileno()).st_size
             elif sanity == Sanity.ASSUME_GAMECUBE:
                 self.fs_type = FSType.GAMECUBE
             elif sanity == Sanity.ASSUME_WII:
@@ -693,37 +1002,62 @@ tree: a dict representing the root directory.  Each directory is a dict whose
             # string table should start within FST
             if sanity == Sanity.CHECK and self.str_start > fst_end:
                 raise DiskError(_('filesystem table ends too early'))
-            # get file data
-            self.entries = entries = []
-            for i in range(1, n):
-                # get entry offset
-                entry_offset = fs_start + i * 0xc
-                # is_dir, str_offset, start, size
-                args = ((0x0, 0x1), (0x1, 0x3), (0x4, 0x4), (0x8, 0x4))
-                data = [read(f, entry_offset + offset, size, True)
-                        for offset, size in args]
-                data[0] = d = bool(data[0])
-                if sanity == Sanity.CHECK:
+            # read the whole table at once, with room for the last filename
+            fst_len = max(fst_end, str_start) - fs_start + 0x200
+            fst = read(f, fs_start, fst_len)
+            if len(fst) < n * 0xc:
+                raise DiskError(_('filesystem table ends too early'))
+            # get file data: each entry is 3 big-endian 4-byte integers
+            table = array(_U32, fst[0xc:n * 0xc])
+            if byteorder == 'little':
+                # switch endianness
+                table.byteswap()
+            words = iter(table)
+            # is_dir, str_offset, start, size
+            self.entries = entries = [
+                (bool(first >> 24), first & 0xffffff, start, size)
+                for first, start, size in zip(words, words, words)
+            ]
+            if sanity == Sanity.CHECK:
+                for d, str_offset, start, size in entries:
                     # string table must be contained within FST
-                    if str_start + data[1] > fst_end:
+                    if str_start + str_offset > fst_end:
                         msg = _('found a file whose name starts too late')
                         raise DiskError(msg)
                     if d:
-                        if data[2] >= n:
+                        if start >= n:
                             msg = _('found a directory with an invalid parent')
                             raise DiskError(msg)
-                        if data[3] > n:
+                        if size > n:
                             msg = _('found an invalid directory entry')
                             raise DiskError(msg)
                     # don't limit file offset/size
-                entries.append(tuple(data))
-            # get filenames
+            # get filenames: split up the string table once, since each name
+            # normally starts right after the previous one
+            by_offset = {}
+            offset = 0
+            # the last piece isn't terminated within the table
+            for name in fst[n * 0xc:fst_end - fs_start].split(b'\0')[:-1]:
+                by_offset[offset] = name
+                offset += len(name) + 1
             self.names = names = []
             for entry in entries:
-                name = read(f, str_start + entry[1], 0x200, False, b'\0', 0x20)
-                if len(name) == 0x200: # 512B
+                name = by_offset.get(entry[1])
+                if name is None:
+                    pos = n * 0xc + entry[1]
+                    name = fst[pos:pos + 0x200]
+                    if len(name) < 0x200 and len(fst) == fst_len:
+                        # starts outside the table (only without sanity
+                        # checks)
+                        name = read(f, str_start + entry[1], 0x200, False,
+                                    b'\0', 0x20)
+                    else:
+                        name = name.split(b'\0', 1)[0]
+                if len(name) >= 0x200: # 512B
                     raise DiskError(_('too long a filename'))
-                names.append(_decode(name))
+                # the same names often appear in many directories, so share
+                # one string between them
+                names.append(intern(_decode(name)))
 
     def build_tree (self, store = True, start = 0, end = None):
         """Build the directory tree from the current entries list.
@@ -790,54 +1124,75 @@ size: the number of children in the tree or the total file size, or a dict of
             sizes = {}
         if done is None:
             done = {}
-        # infinite recursion prevention: return if already counted
-        tree_id = id(tree)
-        if tree_id in done:
-            done[tree_id].append(key)
+        entries = self.entries
+        # sizes of imported files, in case the same file is imported more than
+        # once
+        file_sizes = {}
+        # walk the tree with an explicit stack of
+        # [tree_id, key, children iterator, size] frames
+        stack = []
+
+        def enter (tree, key):
+            # infinite recursion prevention: return False if already counted
+            tree_id = id(tree)
+            if tree_id in done:
+                done[tree_id].append(key)
+                return False
+            # done stores lists of keys for the same tree, as detected above
+            done[tree_id] = []
+            stack.append([tree_id, key, iter(tree.items()), 0])
+            return True
+
+        if not enter(tree, key):
             return sizes if recursive else 0
-        # done stores lists of keys for the same tree, as detected above
-        done[tree_id] = []
-        size = 0
-        for d_key, this_tree in tree.items():
-            if d_key is None:
-                # files
-                if file_size:
-                    entries = self.entries
-                    for f_key in this_tree:
-                        i = f_key[1]
-                        if isinstance(i, int):
-                            this_size = entries[i][3]
-                        else:
-                            try:
-                                this_size = getsize(i)
-                            except OSError:
-                                this_size = 0
-                        size += this_size
-                        if recursive:
-                            sizes[f_key] = this_size
+        while True:
+            frame = stack[-1]
+            for d_key, this_tree in frame[2]:
+                if d_key is None:
+                    # files
+                    if file_size:
+                        for f_key in this_tree:
+                            i = f_key[1]
+                            if isinstance(i, int):
+                                this_size = entries[i][3]
+                            else:
+                                this_size = file_sizes.get(i)
+                                if this_size is None:
+                                    try:
+                                        this_size = getsize(i)
+                                    except OSError:
+                                        this_size = 0
+                                    file_sizes[i] = this_size
+                            frame[3] += this_size
+                            if recursive:
+                                sizes[f_key] = this_size
+                    else:
+                        frame[3] += len(this_tree)
                 else:
-                    size += len(this_tree)
+                    # dir
+                    if not file_size:
+                        frame[3] += 1
+                    if enter(this_tree, d_key):
+                        # descend into this dir before carrying on here
+                        break
+                    # if not in sizes, recursion
+                    if recursive:
+                        frame[3] += sizes.get(d_key, 0)
             else:
-                # dir
-                if not file_size:
-                    size += 1
-                this_size = self.tree_size(this_tree, file_size, recursive,
-                                           d_key, sizes, done)
-                # if not in sizes now, recursion
-                size += sizes.get(d_key, 0) if recursive else this_size
-        if recursive:
-            sizes[key] = size
-            others = done[tree_id]
-            if others:
-                for k in others:
-                    sizes[k] = size
-            # this tree might be somewhere else as well, but we've checked all
-            # children now, so consider that (and possible infinite recursions)
-            # separately
-            del done[tree_id]
-            return sizes
-        else:
-            return size
+                # checked all children
+                stack.pop()
+                tree_id, key, children, size = frame
+                if recursive:
+                    sizes[key] = size
+                    for k in done[tree_id]:
+                        sizes[k] = size
+                # this tree might be somewhere else as well, but we've checked
+                # all children now, so consider that (and possible infinite
+                # recursions) separately
+                del done[tree_id]
+                if not stack:
+                    return sizes if recursive else size
+                stack[-1][3] += sizes.get(key, 0) if recursive else size
 
     def flatten_tree (self, tree = None, files = True, dirs = True, path = []):
         """Get a list of files in the given tree with their parent trees.
@@ -857,18 +1212,34 @@ items: list of (is_dir, item, parent, index, path) tuples, where, if is_dir,
         if tree is None:
             tree = self.tree
         items = []
-        # files
-        if files:
-            for i, f in enumerate(tree[None]):
-                items.append(((False,) if dirs else ()) + (f, tree, i, path))
-        # dirs
-        for k, t in tree.items():
-            if k is not None:
+        file_flag = (False,) if dirs else ()
+        dir_flag = (True,) if files else ()
+        # walk the tree depth-first with an explicit stack of (tree, path,
+        # child iterator), adding each directory's files as we enter it
+        stack = []
+        while True:
+            # files
+            if files:
+                for i, f in enumerate(tree[None]):
+                    items.append(file_flag + (f, tree, i, path))
+            stack.append((tree, path, iter(tree.items())))
+            # dirs: find the next one to enter
+            while stack:
+                tree, path, children = stack[-1]
+                for k, t in children:
+                    if k is not None:
+                        break
+                else:
+                    # finished with this dir
+                    stack.pop()
+                    continue
                 if dirs:
-                    items.append(((True,) if files else ()) + \
-                                 (t, tree, k, path))
-                items += self.flatten_tree(t, files, dirs, path + [k[0]])
-        return items
+                    items.append(dir_flag + (t, tree, k, path))
+                tree = t
+                path = path + [k[0]]
+                break
+            else:
+                return items
 
     def update (self):
         """Re-read data from the disk.  Discards all changes to the tree.
@@ -922,21 +1293,16 @@ Returns a dict containing 'code', 'version' (int), 'name' and
 'apploader version'.
 
 """
-        fields = (
-            ('code', 0x0, 0x4),
-            ('version', 0x7, 0x1, True),
-            # unlikely to have a game name longer than 256 characters
-            ('name', 0x20, 0x100, False, b'\0', 0x30),
-            ('apploader version', 0x2440, 0xa)
-        )
-        data = {}
+        # read all the fields at once, then pick them out in memory
         with open(self.fn, 'rb') as f:
-            for name, *args in fields:
-                this_data = read(f, *args)
-                if isinstance(this_data, bytes):
-                    this_data = _decode(this_data)
-                data[name] = this_data
-        return data
+            header = read(f, 0, 0x244a)
+        return {
+            'code': _decode(header[0x0:0x4]),
+            'version': int.from_bytes(header[0x7:0x8], 'big'),
+            # unlikely to have a game name longer than 256 characters
+            'name': _decode(header[0x20:0x120].split(b'\0', 1)[0]),
+            'apploader version': _decode(header[0x2440:0x244a])
+        }
 
     def get_bnr_info (self, index = None):
         """Get game information from a BNR file.
@@ -973,15 +1339,17 @@ Returns a dict with 'img' (bytes), 'name', 'developer', 'full name',
             ('description', 0x18e0, 0x80, False, b'\0', 0x80),
         )
         data = {}
+        # read the whole banner at once, then pick the fields out in memory
         with open(self.fn, 'rb') as f:
-            # check for magic word
-            if read(f, offset, 0x4) not in (b'BNR1', b'BNR2'):
-                raise ValueError('invalid BNR file')
-            for name, start, *args in fields:
-                this_data = read(f, offset + start, *args)
-                if name != 'img':
-                    this_data = _decode(this_data)
-                data[name] = this_data
+            bnr = BytesIO(read(f, offset, 0x1960))
+        # check for magic word
+        if read(bnr, 0, 0x4) not in (b'BNR1', b'BNR2'):
+            raise ValueError('invalid BNR file')
+        for name, start, *args in fields:
+            this_data = read(bnr, start, *args)
+            if name != 'img':
+                this_data = _decode(this_data)
+            data[name] = this_data
         return data
 
     def get_extra_files (self):
@@ -1031,18 +1399,22 @@ failed: a list of indices in the given files list for files that could not be
 """
         all_files = {f[0]: f[1:] for f in self.get_extra_files()}
         failed = []
-        with open(self.fn, 'rb') as f:
-            for i, (name, dest) in enumerate(files):
-                try:
-                    start, size = all_files[name]
-                except KeyError:
-                    # unknown file
-                    failed.append(i)
-                else:
-                    to_copy = [((f, start, size), dest)]
-                    if copy(to_copy, None, None, overwrite):
-                        failed.append(i)
-        return failed
+        to_copy = []
+        indices = []
+        for i, (name, dest) in enumerate(files):
+            try:
+                start, size = all_files[name]
+            except KeyError:
+                # unknown file
+                failed.append(i)
+            else:
+                to_copy.append(((self.fn, start, size), dest))
+                indices.append(i)
+        # each copy opens the image itself so that files can be extracted in
+        # parallel
+        copy_failed = copy(to_copy, None, None, overwrite,
+                           threads = COPY_THREADS)
+        return sorted(failed + [indices[i] for i in copy_failed])
 
     def extract (self, files, overwrite = False, progress = None):
         """Extract files from the filesystem.
@@ -1089,11 +1461,16 @@ Directories are extracted recursively.
 """
         entries = self.entries
         names = self.names
-        # build trees for dirs
+        # build trees for dirs; files is then used as a queue
         _files = files
-        files = []
+        files = deque()
         total = 0
         for i, dest in _files:
+            # remove trailing separator (paths we build from these won't have
+            # one)
+            sep = _sep(dest)
+            while dest.endswith(sep):
+                dest = dest[:-1]
             if isinstance(i, int):
                 if i < 0:
                     # root
@@ -1115,59 +1492,68 @@ Directories are extracted recursively.
         to_copy = []
         to_copy_names = []
         failed_pool = []
-        disk_fn = self.fn
-        with open(disk_fn, 'rb') as f:
-            # create directory trees and compile files to copy
-            while files:
-                orig_i, dest, i = files.pop(0)
-                # remove trailing separator
-                sep = _sep(dest)
-                while dest.endswith(sep):
-                    dest = dest[:-1]
-                # get entry data
-                if isinstance(i, dict):
-                    # create dir
-                    try:
-                        os.mkdir(dest)
-                    except OSError as e:
-                        if not overwrite or e.errno != 17:
-                            # unknown error
-                            failed.append((orig_i, dest))
-                            continue
-                        # else already exists and we want to ignore this
-                    # add children to extract list: files
-                    for name, j in i[None]:
-                        files.append((j, _join(dest, name), j))
-                    # dirs
-                    for k, child_tree in i.items():
-                        if k is not None:
-                            name, j = k
-                            files.append((j, _join(dest, name), child_tree))
+        failed = []
+        # if the image can be read at positions without seeking, every copy
+        # shares one file object, else each copy opens the image itself; in
+        # either case, files can be extracted in parallel
+        try:
+            disk = open(self.fn, 'rb')
+        except IOError:
+            # copying each file will fail
+            disk = None
+        if disk is not None and _fileno(disk) is None:
+            disk.close()
+            disk = None
+        disk_src = self.fn if disk is None else disk
+        # create directory trees and compile files to copy
+        while files:
+            orig_i, dest, i = files.popleft()
+            # get entry data
+            if isinstance(i, dict):
+                # create dir
+                try:
+                    os.mkdir(dest)
+                except OSError as e:
+                    if not overwrite or e.errno != 17:
+                        # unknown error
+                        failed.append((orig_i, dest))
+                        continue
+                    # else already exists and we want to ignore this
+                # add children to extract list: files
+                for name, j in i[None]:
+                    files.append((j, _join(dest, name), j))
+                # dirs
+                for k, child_tree in i.items():
+                    if k is not None:
+                        name, j = k
+                        files.append((j, _join(dest, name), child_tree))
+            else:
+                # file
+                if isinstance(i, int):
+                    # extract
+                    start, size = entries[i][2:]
+                    to_copy.append(((disk_src, start, size), dest))
+                    to_copy_names.append(names[i])
                 else:
-                    # file
-                    if isinstance(i, int):
-                        # extract
-                        start, size = entries[i][2:]
-                        to_copy.append(((f, start, size), dest))
-                        to_copy_names.append(names[i])
-                    else:
-                        # copy
-                        to_copy.append((i, dest))
-                        to_copy_names.append(i)
-                    failed_pool.append((orig_i, dest))
-            # extract files
-            failed = copy(to_copy, progress, to_copy_names, overwrite, True)
-            if isinstance(failed, int):
-                # cancelled
-                return failed
-        return [failed_pool[i] for i in failed]
+                    # copy
+                    to_copy.append((i, dest))
+                    to_copy_names.append(i)
+                failed_pool.append((orig_i, dest))
+        # extract files
+        try:
+            copy_failed = copy(to_copy, progress, to_copy_names, overwrite,
+                               True, COPY_THREADS)
+        finally:
+            if disk is not None:
+                disk.close()
+        if isinstance(copy_failed, int):
+            # cancelled
+            return copy_failed
+        return failed + [failed_pool[i] for i in copy_failed]
 
     def _align_4B (self, x):
         """Align the given number to the next multiple of 4."""
-        x, r = divmod(x, 4)
-        if r > 0:
-            x += 1
-        return x * 4
+        return (x + 3) & ~3
 
     def write (self, tmp_dir = None, progress = None):
         """Write the current tree to the image.
@@ -1206,37 +1592,48 @@ be imported in the same call to this function.
 """
         old_entries = self.entries
         old_names = self.names
-        tree = deepcopy(self.tree)
+        # the tree is only read, so it doesn't need copying
+        tree = self.tree
         # compile new filesystem/string tables
-        tree[None] = [f + (True,) for f in tree[None]]
         entries = []
         old_files = []
         moving_files = []
         new_files = []
         names = []
+        # encoded names, for the string table
+        enc_names = []
         str_start = 0
+
+        def sorted_children (tree):
+            # get a dir's files and dirs together as (child, is_file), sorted by
+            # name; each name is uppercased once, not on every comparison
+            keyed = [(f[0].upper(), (f, True)) for f in tree[None]]
+            keyed += [(k[0].upper(), (k, False)) for k in tree if k is not None]
+            keyed.sort(key = itemgetter(0))
+            return deque(c for key, c in keyed)
+
+        # stack of (tree, children left to add, index) for the dirs we're in,
+        # where index is the dir's index in the filesystem table
         dirs = []
-        parent_indices = {id(tree): 0}
-        done = False
-        sort_key = lambda c: c[0].upper()
+        children = sorted_children(tree)
+        dir_index = 0
         while True:
-            while len(tree) == 1 and not tree[None]:
-                # go up one dir
+            if not children:
                 if dirs:
-                    tree = dirs.pop()
-                else:
-                    done = True
-                    break
-            if done:
+                    # finished with this dir, so the next entry is the first
+                    # one after it
+                    is_dir, this_str_start, parent, next_index = \
+                        entries[dir_index - 1]
+                    entries[dir_index - 1] = (True, this_str_start, parent,
+                                              len(entries) + 1)
+                    # go up one dir
+                    tree, children, dir_index = dirs.pop()
+                    continue
                 break
-            # find next file or dir alphabetically
-            children = tree[None]
-            # += causes the original list to be modified
-            children = children + [k for k in tree if k is not None]
-            child = min(children, key = sort_key)
-            if len(child) == 3:
-                # file
-                name, old_i = child[:2]
+            # next file or dir alphabetically
+            child, is_file = children.popleft()
+            if is_file:
+                name, old_i = child
                 names.append(_decoded(name))
                 i = len(entries)
                 if isinstance(old_i, int):
@@ -1261,24 +1658,23 @@ be imported in the same call to this function.
                     old_start, size = old_entries[old_i][2:]
                     moving_files.append((old_i, i, old_start, start, size))
                 entries.append((False, str_start, start, size))
-                # update tree
-                tree[None].remove(child)
             else:
-                assert len(child) == 2
                 # dir
-                new_tree = tree[child]
-                dirs.append(tree)
-                parent = parent_indices[id(tree)]
-                del tree[child]
-                tree = new_tree
-                tree[None] = [f + (True,) for f in tree[None]]
-                name = _decoded(child[0])
-                names.append(name)
-                next_index = len(entries) + 2 + self.tree_size(tree)
-                entries.append((True, str_start, parent, next_index))
-                parent_indices[id(tree)] = len(entries)
+                dirs.append((tree, children, dir_index))
+                tree = tree[child]
+                children = sorted_children(tree)
+                # keep the name as given, so bytes aren't decoded and then
+                # encoded again
+                name = child[0]
+                names.append(_decoded(name))
+                # the index of the next entry after this dir is set once we
+                # leave it
+                entries.append((True, str_start, dir_index, None))
+                dir_index = len(entries)
+            name = _encoded(name)
+            enc_names.append(name)
             # terminate with a null byte
-            str_start += len(_encode(name)) + 1
+            str_start += len(name) + 1
         # get start of actual file data
         # str_start is now the string table size
         data_start = self.fs_start + (1 + len(entries)) * 0xc + str_start
@@ -1291,198 +1687,238 @@ be imported in the same call to this function.
                 except OSError:
                     pass
 
-        def cleanup (f = None):
+        def cleanup ():
             cleanup_tmp_dir()
-            # return disk image to original size if expanded
-            if truncated:
-                if f is None:
+            # return disk image to original size if expanded, and close it
+            # (an error we raise may pass through here again on its way out)
+            if f.closed:
+                return
+            with f:
+                if truncated:
                     try:
-                        with open(self.fn, 'r+b') as f:
-                            f.truncate(orig_disk_size)
+                        f.truncate(orig_disk_size)
                     except IOError:
                         pass
-                else:
-                    f.truncate(orig_disk_size)
 
-        def error (msg, f = None, cls = IOError):
-            cleanup(f)
+        def error (msg, cls = IOError):
+            cleanup()
             # raise error
             e = cls(msg)
             e.handled = True
             raise e
 
+        # open the image once for every stage of writing to it; from here on,
+        # any way out goes through cleanup, which closes it (and returns it to
+        # its original size if we didn't finish)
+        try:
+            f = open(self.fn, 'r+b')
+        except IOError as e:
+            cleanup_tmp_dir()
+            e.handled = True
+            raise
+        # any copy that extends the image allocates the space up front, so
+        # remember the size to go back to if we fail or are cancelled
         truncated = False
-        if moving_files:
-            orig_disk_size = getsize(self.fn)
-            # copy files within disk image
+        try:
             try:
-                with open(self.fn, 'r+b') as f:
-                    # if we will be seeking beyond the image end, expand it
-                    end = f.seek(0, 2)
-                    last_start = max(f[3] for f in moving_files)
-                    if end < last_start:
-                        truncated = True
-                        f.truncate(last_start)
-                    # copy
+                orig_disk_size = getsize(self.fn)
+            except IOError as e:
+                e.handled = True
+                raise
+            if moving_files:
+                # copy files within disk image
+                try:
+                    # if we will be writing beyond the image end, expand it
+                    last_end = max(start + size for old_i, i, old_start,
+                                   start, size in moving_files)
+                    truncated = _prepare_copy(f, last_end)
+                    # copy in order of destination, so that we write through
+                    # the image sequentially
                     fn = self.fn
                     to_copy = []
                     to_copy_names = []
+                    moving_files.sort(key = lambda f: f[3])
                     for old_i, i, old_start, start, size in moving_files:
                         to_copy.append(((f, old_start, size), (f, start)))
                         to_copy_names.append(names[i])
                         # put in old_files
                         old_files.append((start, i, old_i, size))
-                    failed = copy(to_copy, progress, names, can_cancel = True)
+                    # if no file is moved over where another is moved from,
+                    # and the image can be written to at positions without
+                    # seeking, move several files at once
+                    threads = 1
+                    if _fileno(f) is not None and _moves_independent(
+                        [m[2:] for m in moving_files]
+                    ):
+                        threads = COPY_THREADS
+                    failed = copy(to_copy, progress, to_copy_names,
+                                  can_cancel = True, threads = threads)
                     if isinstance(failed, int):
                         # cancelled
-                        cleanup(f)
+                        cleanup()
                         return failed
                     elif failed:
                         msg = _('couldn\'t read from and write to the disk '
                                 'image')
-                        error(msg, f)
-            except IOError as e:
-                cleanup()
-                e.handled = True
-                raise
-        # sort existing files by position
-        old_files.sort()
-        # get existing files overwritten by the filesystem/string tables and
-        # extract them to a temp dir
-        # don't bother including this in the progress calculations, because
-        # unless we're adding a crazy amount of files with crazily long names,
-        # it won't take any time at all
-        # get number of files to extract
-        n = 0
-        for i, f in enumerate(old_files):
-            if f[0] >= data_start:
-                n = i
-                break
-        if n > 0:
-            tmp_dir = tempfile.mkdtemp(prefix = 'gcutil', dir = tmp_dir)
-            to_extract = []
-            for j in range(n):
+                        error(msg)
+                except IOError as e:
+                    cleanup()
+                    e.handled = True
+                    raise
+            # sort existing files by position
+            old_files.sort()
+            # get existing files overwritten by the filesystem/string tables
+            # and extract them to a temp dir
+            # don't bother including this in the progress calculations,
+            # because unless we're adding a crazy amount of files with crazily
+            # long names, it won't take any time at all
+            # get number of files to extract
+            n = 0
+            for i, old in enumerate(old_files):
+                if old[0] >= data_start:
+                    n = i
+                    break
+            if n > 0:
+                tmp_dir = tempfile.mkdtemp(prefix = 'gcutil', dir = tmp_dir)
+                to_extract = []
                 # move from old_files to new_files
-                start, i, old_i, size = old_files.pop(0)
-                new_files.append((size, i))
-                # get temp file to extract to
-                f = tempfile.NamedTemporaryFile(prefix = '', dir = tmp_dir,
-                                                delete = False)
-                fn = f.name
-                f.close()
-                to_extract.append((start, (old_i, fn)))
-                # change entry
-                entries[i] = (False, entries[i][1], fn, size)
-            # sort by position
-            to_extract.sort()
-            # extract
-            failed = self.extract([f[1] for f in to_extract], True)
-            if failed is True:
-                # cancelled
-                cleanup()
-                return True
-            elif failed:
-                msg = _('couldn\'t extract to a temporary file ({})')
-                error(msg.format(failed[0][1]))
-
-        # copy new files to the image
-        if new_files:
-            # track progress
-            total = sum(size for size, i in new_files)
-            copied = 0
-            # get free space in the filesystem
-            free = []
-            l = [(data_start, None, None, 0)] + old_files
-            align = self._align_4B
-            for j in range(len(l) - 1):
-                start = align(l[j][0] + l[j][3])
-                end = l[j + 1][0]
-                gap = end - start
-                if gap > 0:
-                    free.append((gap, start))
-            # fit new files to gaps: sort both by size
-            if old_files:
-                last_file = old_files[-1]
-                end = last_file[0] + last_file[3]
-            else:
-                end = data_start
-            end = align(end)
-            new_files.sort(reverse = True)
-            free.sort(reverse = True)
-            # take the largest file
-            for file_i, (size, i) in enumerate(new_files):
-                # and put it in the smallest possible gap
-                gap_i = -1
-                for gap_i, (gap, gap_start) in enumerate(free):
-                    if gap < size:
-                        gap_i -= 1
-                        break
-                if gap_i < 0:
-                    # either no gaps or won't fit in any: place at the end
-                    start = end
-                    end = align(end + size)
+                for start, i, old_i, size in old_files[:n]:
+                    new_files.append((size, i))
+                    # get temp file to extract to
+                    fd, fn = tempfile.mkstemp(prefix = '', dir = tmp_dir)
+                    os.close(fd)
+                    to_extract.append((start, (old_i, fn)))
+                    # change entry
+                    entries[i] = (False, entries[i][1], fn, size)
+                del old_files[:n]
+                # sort by position
+                to_extract.sort()
+                # extract (this reads the image in order and writes the temp
+                # files from several threads at once)
+                f.flush()
+                failed = self.extract([f[1] for f in to_extract], True)
+                if failed is True:
+                    # cancelled
+                    cleanup()
+                    return True
+                elif failed:
+                    msg = _('couldn\'t extract to a temporary file ({})')
+                    error(msg.format(failed[0][1]))
+
+            # copy new files to the image
+            if new_files:
+                # track progress
+                total = sum(size for size, i in new_files)
+                copied = 0
+                # get free space in the filesystem: between the (aligned) end
+                # of the tables or the files so far and the start of the next
+                # file; files can be inside others (eg. empty files), so gaps
+                # start at the furthest any file reaches, not at the previous
+                # file's end
+                align = self._align_4B
+                end = align(data_start)
+                free = []
+                for old in old_files:
+                    start = old[0]
+                    if start > end:
+                        gap = start - end
+                        if free and sum(free[-1]) == end:
+                            # only empty files in between: merge with the
+                            # last gap
+                            free[-1] = (free[-1][0] + gap, free[-1][1])
+                        else:
+                            free.append((gap, end))
+                    end = max(end, (start + old[3] + 3) & ~3)
+                # fit new files to gaps: sort both by size
+                new_files.sort(reverse = True)
+                if len(new_files) == 1:
+                    # only one file to place (eg. replacing a file), so all
+                    # that matters is the smallest gap it fits in
+                    size = new_files[0][0]
+                    free = [gap for gap in free if gap[0] >= size]
+                    if free:
+                        free = [min(free)]
                 else:
-                    # alter the gap entry
-                    gap, gap_start = free[gap_i]
-                    start = gap_start
-                    gap_end = gap_start + gap
-                    gap_start = align(gap_start + size)
-                    gap = gap_end - gap_start
-                    if gap > 0:
-                        free[gap_i] = (gap, gap_start)
-                        free.sort(reverse = True)
+                    # gaps are kept sorted by size so we can bisect to find one
+                    free.sort()
+                # track where the last new file ends
+                new_end = 0
+                # take the largest file
+                for file_i, (size, i) in enumerate(new_files):
+                    # and put it in the smallest possible gap
+                    gap_i = bisect_left(free, (size,))
+                    if gap_i == len(free):
+                        # either no gaps or won't fit in any: place at the end
+                        start = end
+                        end = align(end + size)
                     else:
-                        free.pop(gap_i)
-                new_files[file_i] = (start, size, start + size, i)
-            # split into files that do/don't overwrite existing files
-            # sort both lists
-            new_files.sort()
-            old_files_all = iter(sorted((st, sz, st + sz) for d, ss, st, sz \
-                                        in old_entries if not d))
-            # also sum up sizes for progress calculations
-            nf_clean = []
-            total_clean = 0
-            nf_dirty = []
-            total_dirty = 0
-            # get first old file
-            try:
-                f_start, f_size, f_end = next(old_files_all)
-            except StopIteration:
-                f_start = None
-            for start, size, end, i in new_files:
-                clean = True
-                while f_start is not None: # else no old files left
-                    if f_end <= start:
-                        # old before new: get next old file
-                        try:
-                            f_start, f_size, f_end = next(old_files_all)
-                        except StopIteration:
-                            f_start = None
-                    elif f_start >= end:
-                        # old after new: no more old files will overlap
-                        break
+                        # alter the gap entry
+                        gap, gap_start = free[gap_i]
+                        start = gap_start
+                        gap_end = gap_start + gap
+                        gap_start = align(gap_start + size)
+                        gap = gap_end - gap_start
+                        if gap > 0:
+                            # the gap only gets smaller, so it can only move
+                            # earlier; often it stays where it is
+                            new_gap_i = bisect_left(free, (gap, gap_start), 0,
+                                                    gap_i)
+                            if new_gap_i == gap_i:
+                                free[gap_i] = (gap, gap_start)
+                            else:
+                                del free[gap_i]
+                                free.insert(new_gap_i, (gap, gap_start))
+                        else:
+                            del free[gap_i]
+                    new_files[file_i] = (start, size, start + size, i)
+                    new_end = max(new_end, start + size)
+                # split into files that do/don't overwrite existing files
+                # sort both lists
+                new_files.sort()
+                old_files_all = iter(sorted((st, sz, st + sz)
+                                            for d, ss, st, sz in old_entries
+                                            if not d))
+                # also sum up sizes for progress calculations
+                nf_clean = []
+                total_clean = 0
+                nf_dirty = []
+                total_dirty = 0
+                # get first old file
+                try:
+                    f_start, f_size, f_end = next(old_files_all)
+                except StopIteration:
+                    f_start = None
+                for start, size, end, i in new_files:
+                    clean = True
+                    while f_start is not None: # else no old files left
+                        if f_end <= start:
+                            # old before new: get next old file
+                            try:
+                                f_start, f_size, f_end = next(old_files_all)
+                            except StopIteration:
+                                f_start = None
+                        elif f_start >= end:
+                            # old after new: no more old files will overlap
+                            break
+                        else:
+                            # overlap
+                            clean = False
+                            break
+                    if clean:
+                        total_clean += size
+                        nf_clean.append((start, i))
                     else:
-                        # overlap
-                        clean = False
-                        break
-                if clean:
-                    total_clean += size
-                    nf_clean.append((start, i))
-                else:
-                    total_dirty += size
-                    nf_dirty.append((start, i))
-            # sort by start for the potential speedup of not seeking as much
-            nf_clean.sort()
-            nf_dirty.sort()
-            # actually copy
-            clean = True
-            try:
-                with open(self.fn, 'r+b') as f:
-                    # if we will be seeking beyond the image end, expand it
-                    end = f.seek(0, 2)
-                    last_start = max(start for start, i in nf_clean + nf_dirty)
-                    if end < last_start:
-                        f.truncate(last_start)
+                        total_dirty += size
+                        nf_dirty.append((start, i))
+                # sort by start for the potential speedup of not seeking as
+                # much
+                nf_clean.sort()
+                nf_dirty.sort()
+                # actually copy
+                clean = True
+                try:
+                    # if we will be writing beyond the image end, expand it
+                    truncated = _prepare_copy(f, new_end) or truncated
                     # split up the progress function
                     total = total_clean + total_dirty
                     p_clean = lambda d, t, n: (None if progress is None
@@ -1492,8 +1928,10 @@ be imported in the same call to this function.
                             d += total_clean
                         return (None if progress is None
                                 else progress(d, total, n))
-                    # perform the copy
+                    # perform the copy; if the image can be written to at
+                    # positions without seeking, copy several files at once
                     fn = self.fn
+                    threads = 1 if _fileno(f) is None else COPY_THREADS
                     for clean in (True, False):
                         to_copy = []
                         to_copy_names = []
@@ -1503,54 +1941,63 @@ be imported in the same call to this function.
                             to_copy_names.append(names[i])
                             entries[i] = (False, str_start, start, size)
                         failed = copy(to_copy, p_clean if clean else p_dirty,
-                                      to_copy_names, can_cancel = clean)
+                                      to_copy_names, can_cancel = clean,
+                                      threads = threads)
                         if isinstance(failed, int):
                             # cancelled
-                            cleanup(f)
+                            cleanup()
                             return failed
                         elif failed:
                             msg = _('either couldn\'t read from \'{}\' or '
                                     'couldn\'t write to the disk image')
                             msg = msg.format(to_copy[failed[0]][0][0])
                             if clean:
-                                error(msg, f)
+                                error(msg)
                             else:
-                                cleanup(f)
+                                cleanup()
                                 raise IOError(msg)
-            except IOError as e:
-                cleanup()
-                if clean:
-                    e.handled = True
-                raise
+                except IOError as e:
+                    cleanup()
+                    if clean:
+                        e.handled = True
+                    raise
 
-        cleanup_tmp_dir()
-        # get new fst_size, num_entries, str_start
-        self.fst_size = data_start - self.fs_start
-        self.num_entries = len(entries) + 1
-        self.str_start = self.fs_start + self.num_entries * 0xc
-        # write new fst_size and filesystem/string tables to the image
-        self.entries = entries
-        self.names = names
-        with open(self.fn, 'r+b') as f:
-            write(self.fst_size, f, 0x428, 0x4)
-            write(self.fst_size, f, 0x42c, 0x4)
-            root = (True, 0, 0, self.num_entries)
-            args = ((0x0, 0x1), (0x1, 0x3), (0x4, 0x4), (0x8, 0x4))
-            offset = self.fs_start
-            for k, entry in enumerate([root] + self.entries):
-                for data, (pos, size) in zip(entry, args):
-                    write(int(data), f, offset + pos, size) # is_dir is bool
-                offset += 0xc
-            pos = self.str_start
-            for name in names:
-                name = _encode(name)
-                write(name + b'\0', f, pos)
-                pos += len(name) + 1
-            # truncate image to new size if necessary
-            ends = [st + sz for d, ss, st, sz in entries if not d]
-            end = max([data_start] + ends)
-            if end < f.seek(0, 2):
-                f.truncate(end)
+            cleanup_tmp_dir()
+            # get new fst_size, num_entries, str_start
+            self.fst_size = data_start - self.fs_start
+            self.num_entries = len(entries) + 1
+            self.str_start = self.fs_start + self.num_entries * 0xc
+            # write new fst_size and filesystem/string tables to the image
+            self.entries = entries
+            self.names = names
+            with f:
+                # the size and maximum size fields are next to each other
+                write(self.fst_size.to_bytes(4, 'big') * 2, f, 0x428)
+                # build the tables in memory and write them all at once: the
+                # filesystem table is just big-endian 4-byte integers
+                # also find the end of the last file while we're at it
+                # the root directory's entry comes first, and holds the number
+                # of entries
+                fst = array(_U32, (1 << 24, 0, self.num_entries))
+                end = data_start
+                for is_dir, str_start, start, size in self.entries:
+                    # is_dir is the first byte of the first field
+                    fst.extend(((is_dir << 24) | str_start, start, size))
+                    if not is_dir and start + size > end:
+                        end = start + size
+                if byteorder == 'little':
+                    # switch endianness
+                    fst.byteswap()
+                # every name is null-terminated, including the last
+                enc_names.append(b'')
+                fst = fst.tobytes() + b'\0'.join(enc_names)
+                write(fst, f, self.fs_start)
+                # truncate image to new size if necessary
+                f.flush()
+                if end < os.fstat(f.fileno()).st_size:
+                    f.truncate(end)
+        finally:
+            cleanup()
         # build new tree
         self.build_tree()
         return False
@@ -1576,7 +2023,9 @@ See compress for more details.
         files = [[entries[i][2], entries[i][3], i, name, parent[None], tree_i]
                  for (name, i), parent, tree_i, path in files]
         files.sort(reverse = True)
-        orig_size = sum(files[0][:2])
+        # files can be inside others (eg. empty files), so the last file to
+        # start isn't necessarily the last to end
+        orig_size = max(f[0] + f[1] for f in files)
         # get start of file data
         data_start, i = max((e[1], i) for i, e in enumerate(entries))
         if i != -1:
@@ -1585,53 +2034,62 @@ See compress for more details.
         # get free space in the filesystem, sorted by position, aligned to
         # 4-bytes blocks
         free = []
-        l = [(data_start, 0)] + list(reversed(files))
         align = self._align_4B
-        for j in range(len(l) - 1):
-            start = align(l[j][0] + l[j][1])
-            end = l[j + 1][0]
-            gap = end - start
-            if gap > 0:
-                free.append((start, gap))
-        free.sort()
+        # the furthest any file reaches so far: gaps start here, not at the
+        # end of the previous file, since that might be inside another one
+        end = align(data_start)
+        for f in reversed(files):
+            start = f[0]
+            if start > end:
+                if free and sum(free[-1]) == end:
+                    # only empty files in between: merge with the last gap
+                    free[-1] = (free[-1][0], start - free[-1][0])
+                else:
+                    free.append((end, start - end))
+            end = max(end, (start + f[1] + 3) & ~3)
+        free = _Gaps(free)
         # repeatedly try to move every file earlier until none can
         changed = False
         this_changed = True
         while this_changed:
             this_changed = False
             # starting with the last file,
-            n = 0
             for f_data in files:
                 pos, size, i, name, d, d_i = f_data
+                # once there are no gaps before this file, there are none
+                # before any of the remaining (earlier) files either
+                if free.find(1, pos) == -1:
+                    break
                 # put each file in the earliest possible gap
-                for gap_i, (start, gap) in enumerate(free):
-                    if gap >= size and start < pos:
-                        # mark file moved
-                        d[d_i] = (name, (i, start))
-                        f_data[0] = start
-                        # change gap entry
-                        end = start + gap
-                        start = align(start + size)
-                        gap = end - start
-                        if gap > 0:
-                            free[gap_i] = (start, gap)
-                            free.sort()
-                        else:
-                            free.pop(gap_i)
-                        this_changed = True
-                        changed = True
-                        n += 1
-                        break
-            # resort files
-            files.sort(reverse = True)
-        # move last file to end of previous file if possible
-        start = align(sum(files[1][:2]) if len(files) > 1 else data_start)
+                gap_i = free.find(size, pos)
+                if gap_i == -1:
+                    continue
+                start, gap = free.gaps[gap_i]
+                # mark file moved
+                d[d_i] = (name, (i, start))
+                f_data[0] = start
+                # change gap entry (this keeps gaps in position order)
+                end = start + gap
+                start = align(start + size)
+                free.set(gap_i, start, max(end - start, 0))
+                this_changed = True
+                changed = True
+            if this_changed:
+                # resort files
+                files.sort(reverse = True)
+        # move last file to the end of the others if possible; this must
+        # also be past where the others were, since they might not have been
+        # moved out of the way yet when this one is written
+        start = data_start
+        for pos, size, i, name, d, d_i in files[1:]:
+            start = max(start, pos + size, entries[i][2] + size)
+        start = align(start)
         pos, size, i, name, d, d_i = files[0]
         if pos > start:
             d[d_i] = (name, (i, start))
-            files[0][0] = pos
+            files[0][0] = start
             changed = True
-        return (changed, orig_size, sum(files[0][:2]))
+        return (changed, orig_size, max(f[0] + f[1] for f in files))
 
     def _slow_compress (self, tmp_dir, progress = None):
         """Slow compress of the image.
@@ -1753,13 +2211,19 @@ If it can be compressed to become small enough, it is compressed and then
 decompressed; otherwise, ValueError is raised (and has a 'handled' attribute
 which is True).
 
+IMPORTANT: if compression is attempted, any changes that have been made to the
+tree are discarded first, as for compress.
+
         """
         target_size = 1459978240
-        size = max(0, *(
-            start + size for is_dir, str_start, start, size in self.entries
-        ))
+        # only files' fields are positions in the image
+        ends = [start + size for is_dir, str_start, start, size
+                in self.entries if not is_dir]
+        size = max(ends) if ends else 0
         if size > target_size:
-            # too large: try compressing
+            # too large: try compressing; this moves files around in the tree,
+            # so start from a new one rather than changing the current one
+            self.build_tree()
             changed, orig_size, new_size = self._quick_compress()
             if changed and new_size <= target_size:
                 # can get small enough by compressing
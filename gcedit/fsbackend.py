@@ -19,10 +19,12 @@ FSBackend
 # [BUG] can't undo moving a directory inside itself
 
 import os
-from copy import deepcopy
 from html import escape
+from collections import deque
+from functools import lru_cache
 
 from gi.repository import Gtk as gtk
+from gi.repository.GLib import idle_add
 from .ext import gcutil
 
 from . import guiutil
@@ -30,6 +32,17 @@ from . import conf
 from .conf import settings
 
 
+def _copy_tree (tree):
+    """Copy a tree so that it can be changed independently of the original.
+
+Only the dicts and file lists are copied: names and indices are immutable, so
+they are shared.
+
+"""
+    return {k: list(v) if k is None else _copy_tree(v)
+            for k, v in tree.items()}
+
+
 class FSBackend:
     """The backend for fsmanage, to make changes to the filesystem.
 
@@ -57,13 +70,27 @@ fs, editor: the arguments given to the constructor.
         self.fs = fs
         self.editor = editor
         self._init()
+        self._refresh_pending = False
         # initial file list
         self._files = self._get_files()
 
     def _init (self):
         """Do some initialisation."""
-        self._hist_pos = 0
-        self._hist = []
+        # actions to undo and redo, each with the most recent last
+        self._undo = []
+        self._redo = []
+        # lookup caches for get_tree and get_file, by path; these are checked
+        # against the tree before use, so changes never make them wrong, and
+        # they're cleared whenever a directory is removed, so they only hold
+        # paths that exist
+        self._dir_keys = {}
+        self._file_indices = {}
+        # {id(tree): [tree, copies]} for directories that appear in more than
+        # one place, since copies share trees until they're changed; copies is
+        # how many places there are besides the first, and the entry goes once
+        # they've all been replaced (this is only reset along with the history,
+        # once the tree has been rebuilt)
+        self._shared = {}
         self._sizes = {}
         self._update_sizes()
 
@@ -88,14 +115,18 @@ This is an {entries index: path} dict.
         files = set(self._get_files())
         return {i: old_files[i] for i in set(old_files) - files}
 
-    def get_tree (self, path, return_parent = False):
+    def get_tree (self, path, return_parent = False, own = False):
         """Get the tree for the given path.
 
-get_tree(path, return_parent = False) -> rtn
+get_tree(path, return_parent = False, own = False) -> rtn
 
 path: hierarchical list of directories.
 return_parent: whether to return the parent of the required tree rather than
                the tree itself.
+own: pass True if the returned tree is going to be changed; any directories on
+     the path that are shared with other places are copied first (if
+     return_parent is True, this is only up to the parent, so the path's tree
+     can be moved or removed without being copied).
 
 rtn: if return_parent is False this is the tree for the given path.  Otherwise,
      this is (parent, key), where:
@@ -106,183 +137,366 @@ rtn: if return_parent is False this is the tree for the given path.  Otherwise,
 
 """
         tree = self.fs.tree
+        parent = key = None
+        dir_keys = self._dir_keys
+        shared = self._shared
+        this_path = ()
+        n_own = len(path) - 1 if return_parent else len(path)
         for d in path:
-            found = False
-            for k in tree:
-                if k is not None:
-                    if k[0] == d:
+            this_path += (d,)
+            k = dir_keys.get(this_path)
+            if k is None or k not in tree:
+                # not cached, or changed since
+                for k in tree:
+                    if k is not None and k[0] == d:
                         # found the next dir in path
-                        parent = tree
-                        tree = tree[k]
-                        found = True
+                        dir_keys[this_path] = k
                         break
-            if not found:
-                raise ValueError('invalid path')
+                else:
+                    raise ValueError('invalid path')
+            parent = tree
+            key = k
+            tree = tree[k]
+            if own and id(tree) in shared and len(this_path) <= n_own:
+                tree = parent[k] = self._unshare(tree)
         if return_parent:
-            try:
-                return (parent, k)
-            except NameError:
-                # never found any, but didn't raise an exception: this is root
+            if parent is None:
+                # this is root
                 return (tree, None)
+            return (parent, key)
         else:
             return tree
 
-    def get_file (self, path):
+    def get_file (self, path, own = False):
         """Get the file at the given path in the tree.
 
 Returns (parent, entry), where parent is the file's parent directory and entry
-is its entry in the tree.
+is its entry in the tree.  own is as taken by get_tree.
 
 """
         *path, name = path
-        tree = self.get_tree(path)
-        for entry in tree[None]:
-            if entry[0] == name:
-                return tree, entry
-        # nothing found
-        raise ValueError('invalid path')
+        tree = self.get_tree(path, own = own)
+        files = tree[None]
+        path = tuple(path)
+        # {name: index in files} for this dir
+        indices = self._file_indices.get(path)
+        if indices is not None:
+            i = indices.get(name)
+            if i is not None and i < len(files) and files[i][0] == name:
+                return tree, files[i]
+        # not cached, or changed since
+        indices = {entry[0]: i for i, entry in enumerate(files)}
+        self._file_indices[path] = indices
+        try:
+            return tree, files[indices[name]]
+        except KeyError:
+            # nothing found
+            raise ValueError('invalid path')
+
+    def _share (self, tree):
+        """Mark a tree as being in one more place, and return it."""
+        shared = self._shared
+        this_shared = shared.get(id(tree))
+        if this_shared is None:
+            shared[id(tree)] = [tree, 1]
+        else:
+            this_shared[1] += 1
+        return tree
+
+    def _unshare (self, tree):
+        """Get a copy of a shared tree that can be changed.
+
+The copy replaces one of the tree's places, so it's in one fewer.  Only the top
+level is copied, so the directories in it are shared in turn.
+
+"""
+        shared = self._shared
+        this_shared = shared[id(tree)]
+        this_shared[1] -= 1
+        if this_shared[1] == 0:
+            del shared[id(tree)]
+        tree = {k: list(v) if k is None else v for k, v in tree.items()}
+        share = self._share
+        for k, child in tree.items():
+            if k is not None:
+                share(child)
+        return tree
+
+    def _get_item (self, path, own = False):
+        """Get the file or directory at the given path in the tree.
+
+_get_item(path, own = False) -> (parent, key, tree)
+
+own is as taken by get_tree.
+
+parent: the item's parent directory.
+key: the item's key in its parent, or its entry in the parent's file list.
+tree: the item's tree, or None if it is a file.
+
+"""
+        try:
+            parent, k = self.get_tree(path, True, own)
+        except ValueError:
+            parent, k = self.get_file(path, own)
+            return (parent, k, None)
+        else:
+            return (parent, k, parent[k])
 
-    def _get_size (self, is_dir, path):
-        """Get the total filesize of a path.
+    def _remove (self, path):
+        """Remove an item from the tree without any checks or history.
 
-_get_size(is_dir, path) -> size
+_remove(path) -> (index, tree)
+
+index: the item's index, as used in the tree.
+tree: the item's tree, or None if it is a file.
 
 """
-        if is_dir:
-            key = self.get_tree(path, True)[1]
+        parent, k, tree = self._get_item(path, True)
+        if tree is None:
+            parent[None].remove(k)
         else:
-            key = self.get_file(path)[1]
-        return self._sizes[path[0]][key]
+            del parent[k]
+        self._count_removed(path, tree)
+        return (k[1], tree)
+
+    def _add (self, path, index, tree = None):
+        """Add an item to the tree without any checks or history.
 
-    def _update_sizes (self, *paths):
-        """Add sizes to the cache for the given paths.
+_add(path, index, tree = None)
 
-If no paths are given, update all sizes.
+path: the item's new path.
+index: the item's index, as used in the tree.
+tree: the item's tree, or None if it is a file.
 
 """
-        if paths:
-            paths = {path[0] for path in paths}
+        *dest, name = path
+        dest = self.get_tree(dest, own = True)
+        if tree is None:
+            dest[None].append((name, index))
         else:
-            # get all toplevel paths
-            paths = gcutil.tree_names(self.fs.tree)
-        # update sizes for toplevel parents of paths
-        for name in paths:
-            path = (name,)
+            dest[(name, index)] = tree
+        self._count_added(path, index, tree)
+
+    def _file_size (self, i):
+        """Get the size of a file from its index in the tree."""
+        if isinstance(i, int):
+            return self.fs.entries[i][3]
+        else:
+            # imported
             try:
-                parent, key = self.get_tree(path, True)
-            except ValueError:
-                try:
-                    key = self.get_file(path)[1]
-                    tree = {None: [key]}
-                except ValueError:
-                    continue
-                else:
-                    sizes = self.fs.tree_size(tree, True, True)
-                    sizes = {key: sizes[key]}
-            else:
-                sizes = self.fs.tree_size(parent[key], True, True, key)
-            self._sizes[name] = sizes
+                return os.path.getsize(i)
+            except OSError:
+                return 0
+
+    def _count_sizes (self, path, tree):
+        """Add the sizes of a directory and everything in it to the cache.
+
+_count_sizes(path, tree) -> size
+
+"""
+        sizes = self._sizes
+        file_size = self._file_size
+        total = 0
+        for name, i in tree[None]:
+            size = sizes[path + (name,)] = file_size(i)
+            total += size
+        count_sizes = self._count_sizes
+        for k, child in tree.items():
+            if k is not None:
+                total += count_sizes(path + (k[0],), child)
+        sizes[path] = total
+        return total
+
+    def _update_sizes (self):
+        """Count the sizes of everything in the tree again."""
+        self._sizes = {}
+        self._count_sizes((), self.fs.tree)
+
+    def _count_added (self, path, index, tree = None):
+        """Update the size cache for an item that was added to the tree.
+
+Arguments are as taken by _add.
+
+"""
+        path = tuple(path)
+        sizes = self._sizes
+        if tree is None:
+            size = sizes[path] = self._file_size(index)
+        else:
+            size = self._count_sizes(path, tree)
+        # add to the directories containing it
+        for i in range(len(path)):
+            sizes[path[:i]] += size
+
+    def _count_removed (self, path, tree = None):
+        """Update caches for an item that was removed from the tree.
+
+_count_removed(path, tree = None)
+
+path: the item's old path.
+tree: the item's tree, or None if it was a file.
+
+"""
+        if tree is not None:
+            # anything cached inside it is gone
+            self._dir_keys.clear()
+            self._file_indices.clear()
+        path = tuple(path)
+        sizes = self._sizes
+        # sizes of things inside it are left, but they're replaced if anything
+        # is added there again
+        size = sizes.pop(path)
+        for i in range(len(path)):
+            sizes[path[:i]] -= size
 
     def undo (self):
         """Undo the last action."""
         if not self.can_undo():
             return
-        self._hist_pos -= 1
-        action, data = self._hist[self._hist_pos]
+        action, data = hist = self._undo.pop()
+        self._redo.append(hist)
+        # history is known to be valid, so skip the checks in move and copy
         if action == 'move':
-            self.move(*((new, old) for old, new in data), hist = False)
+            for old, new in reversed(data):
+                try:
+                    self._add(old, *self._remove(new))
+                except ValueError:
+                    # moved into itself
+                    pass
         elif action == 'copy':
             self.delete(*(new for old, new in data), hist = False)
         elif action == 'delete':
             for x in data:
-                parent = self.get_tree(x[0][:-1])
                 if len(x) == 2:
                     # file
-                    parent[None].append(x[1])
+                    self._add(x[0], x[1][1])
                 else:
                     # dir
-                    parent[x[1]] = x[2]
-                self._update_sizes(*(x[0] for x in data))
+                    self._add(x[0], x[1][1], x[2])
         elif action == 'new':
             self.delete(data, hist = False)
         else: # import
             self.delete(*(path for path, f in data), hist = False)
-        self.editor.file_manager.refresh()
+        self._refresh()
         self.editor.hist_update()
 
     def redo (self):
         """Redo the next action."""
         if not self.can_redo():
             return
-        action, data = self._hist[self._hist_pos]
-        self._hist_pos += 1
+        action, data = hist = self._redo.pop()
+        self._undo.append(hist)
         if action == 'move':
-            self.move(*data, hist = False)
+            for old, new in data:
+                try:
+                    self._add(new, *self._remove(old))
+                except ValueError:
+                    # moved into itself
+                    pass
         elif action == 'copy':
-            self.copy(*data, hist = False)
+            for old, new in data:
+                parent, k, tree = self._get_item(old)
+                if tree is not None:
+                    if new[:len(old)] == old:
+                        # into itself
+                        tree = _copy_tree(tree)
+                    else:
+                        self._share(tree)
+                self._add(new, k[1], tree)
         elif action == 'delete':
             self.delete(*(x[0] for x in data), hist = False)
         elif action == 'new':
             self.new_dir(data, hist = False)
         else: # import
-            for (*parent, name), f in data:
-                tree = self.get_tree(parent)
+            for path, f in data:
                 if isinstance(f, dict):
                     # dir
-                    tree[(name, None)] = f
+                    self._add(path, None, f)
                 else:
                     # file
-                    tree[None].append((name, f))
-            self._update_sizes(*(path for path, f in data))
-        self.editor.file_manager.refresh()
+                    self._add(path, f)
+        self._refresh()
         self.editor.hist_update()
 
+    def _refresh (self):
+        """Refresh the file manager once the current event has been handled.
+
+Several calls in a row, such as when undoing a lot at once, only refresh it
+once.
+
+"""
+        if not self._refresh_pending:
+            self._refresh_pending = True
+            idle_add(self._do_refresh)
+
+    def _do_refresh (self):
+        """Idle callback for _refresh."""
+        self._refresh_pending = False
+        self.editor.file_manager.refresh()
+        # don't call again
+        return False
+
     def can_undo (self):
         """Check whether there's anything to undo."""
-        return self._hist_pos > 0
+        return bool(self._undo)
 
     def can_redo (self):
         """Check whether there's anything to redo."""
-        return self._hist_pos < len(self._hist)
+        return bool(self._redo)
 
     def _add_hist (self, data):
         """Add an action to the history."""
-        self._hist = self._hist[:self._hist_pos]
-        self._hist.append(data)
-        self._hist_pos += 1
+        # a new action means the undone ones can't be redone
+        del self._redo[:]
+        self._undo.append(data)
         self.editor.hist_update()
 
-    def _validate_tree (self, tree, src, dest):
-        """Clean up a tree, fixing invalid names."""
+    def _validate_tree (self, tree, src, dest, invalid_name = None):
+        """Clean up a tree, fixing invalid names.
+
+invalid_name is a memoised guiutil.invalid_name to use, so that subdirectories
+can share results.
+
+"""
         names = {}
         for k in tree:
             if k is not None:
                 names[k[0]] = (True, k)
         for k in tree[None]:
             names[k[0]] = (False, k)
-        # check each item
-        to_check = list(names.keys())
+        printable_path = guiutil.printable_path
+        if invalid_name is None:
+            invalid_name = lru_cache(None)(guiutil.invalid_name)
+        move_conflict = guiutil.move_conflict
+        # check each item, in order; names are left in to_check when they're
+        # removed, so unchecked says which still need checking
+        to_check = deque(names)
+        unchecked = set(names)
         while to_check:
-            name = to_check.pop(0)
+            name = to_check.popleft()
+            if name not in unchecked:
+                continue
+            unchecked.remove(name)
             is_dir, k = names[name]
             want_name = name
             this_src = os.path.join(src, name)
             while True:
                 this_dest = dest + [want_name]
-                p_dest = guiutil.printable_path(this_dest)
+                # only build the printable path if we need to ask
                 if want_name != name:
                     # want to rename
                     if want_name in names:
                         # target exists
-                        action = guiutil.move_conflict(this_src, p_dest,
-                                                       self.editor)
+                        p_dest = printable_path(this_dest)
+                        action = move_conflict(this_src, p_dest, self.editor)
                     else:
                         # allow rename
                         action = None
-                elif guiutil.invalid_name(name):
+                elif invalid_name(name):
                     # invalid name
-                    action = guiutil.move_conflict(this_src, p_dest,
-                                                   self.editor, True)
+                    p_dest = printable_path(this_dest)
+                    action = move_conflict(this_src, p_dest, self.editor,
+                                           True)
                 else:
                     break
                 if action is True:
@@ -293,8 +507,7 @@ If no paths are given, update all sizes.
                     else:
                         tree[None].remove(target_k)
                     del names[want_name]
-                    if want_name in to_check:
-                        to_check.remove(want_name)
+                    unchecked.discard(want_name)
                     # rename
                     action = None
                 if action:
@@ -305,7 +518,7 @@ If no paths are given, update all sizes.
                     del names[name]
                     name = want_name
                     new_k = (name, k[1])
-                    names[name] = new_k
+                    names[name] = (is_dir, new_k)
                     if is_dir:
                         data = tree[k]
                         del tree[k]
@@ -323,7 +536,8 @@ If no paths are given, update all sizes.
                     break
             # validate subdirs (but might have been removed from tree)
             if is_dir and k in tree:
-                self._validate_tree(tree[k], this_src, this_dest)
+                self._validate_tree(tree[k], this_src, this_dest,
+                                    invalid_name)
 
     def do_import (self, dirs):
         """Open an import dialogue.
@@ -356,12 +570,16 @@ Takes an argument indicating whether to import directories (else files).
             # import
             current_path = self.editor.file_manager.path
             try:
-                current = self.get_tree(current_path)
+                current = self.get_tree(current_path, own = True)
             except ValueError:
                 d.destroy()
                 guiutil.error(_('Can\'t import to a non-existent directory.'))
                 return
-            current_names = gcutil.tree_names(current)
+            current_names = set(gcutil.tree_names(current))
+            # printable paths of the files are this plus their names
+            p_current = guiutil.printable_path(current_path + [''])
+            # memoised, since imported directories often repeat names
+            invalid_name = lru_cache(None)(guiutil.invalid_name)
             new = []
             new_names = []
             for f in fs:
@@ -369,13 +587,13 @@ Takes an argument indicating whether to import directories (else files).
                 failed = False
                 # check if exists
                 while True:
-                    dest = guiutil.printable_path(current_path + [name])
                     if name in current_names:
                         # exists
-                        action = guiutil.move_conflict(name, dest, self.editor)
-                    elif guiutil.invalid_name(name):
-                        action = guiutil.move_conflict(name, dest, self.editor,
-                                                       True)
+                        action = guiutil.move_conflict(name, p_current + name,
+                                                       self.editor)
+                    elif invalid_name(name):
+                        action = guiutil.move_conflict(name, p_current + name,
+                                                       self.editor, True)
                     else:
                         break
                     # handle action
@@ -389,17 +607,19 @@ Takes an argument indicating whether to import directories (else files).
                         break
                 if not failed:
                     # add to tree
+                    path = current_path + [name]
                     if dirs:
                         tree = gcutil.tree_from_dir(f)
-                        self._validate_tree(tree, f, current_path + [name])
+                        self._validate_tree(tree, f, path, invalid_name)
                         current[(name, None)] = f = tree
+                        self._count_added(path, None, tree)
                     else:
                         current[None].append((name, f))
-                    new.append((current_path + [name], f))
+                        self._count_added(path, f)
+                    new.append((path, f))
                     new_names.append(name)
-                    current_names.append(name)
+                    current_names.add(name)
             if new:
-                self._update_sizes(*(path for path, tree in new))
                 self.editor.file_manager.refresh(*new_names)
                 self._add_hist(('import', new))
 
@@ -412,82 +632,90 @@ Takes an argument indicating whether to import directories (else files).
             guiutil.error(_('Directory doesn\'t exist.'), self.editor)
             items = []
         else:
-            size = self._get_size
             niceify = guiutil.printable_filesize
+            # sizes are cached by path
+            sizes = self._sizes
             items = []
-            for k, v in tree.items():
-                if k is None:
-                    # files
-                    for name, i in v:
-                        this_size = niceify(size(False, path + (name,)))
-                        items.append((name, False, this_size, escape(name)))
-                else:
-                    # dir
+            # files
+            for name, i in tree[None]:
+                size = sizes[path + (name,)]
+                items.append((name, False, niceify(size), escape(name)))
+            # dirs
+            for k in tree:
+                if k is not None:
                     name = k[0]
-                    this_size = niceify(size(True, path + (name,)))
-                    items.append((name, True, this_size, escape(name)))
+                    size = sizes[path + (name,)]
+                    items.append((name, True, niceify(size), escape(name)))
         return items
 
     def open_files (self, *files):
         self.editor.extract(*(f[0] for f in files))
 
     def copy (self, *data, return_failed = False, hist = True,
-              update_sizes = True):
-        failed = []
+              copy_trees = True):
+        # indices in data of items that weren't copied
+        failed = set()
         cannot_copy = []
         said_nodest = False
-        for old, new in data:
+        # destination trees and the names in them, by path: copies usually
+        # share a destination
+        dests = {}
+        for i, (old, new) in enumerate(data):
             foreign = False
             if old[0] is True:
                 # from another Manager: check data is valid
                 this_data, old = old[1:]
                 if not isinstance(this_data, tuple) or len(this_data) != 3 or \
                    this_data[0] != conf.IDENTIFIER:
-                    failed.append(old)
+                    failed.add(i)
                     continue
                 if this_data[2] != id(self.editor):
                     # different Editor
                     foreign = True
                     guiutil.error(_('Drag-and-drop between instances is not '
                                     'supported yet.'))
-                    #print(this_data, old, new)
-                    failed.append(old)
+                    failed.add(i)
                     continue
             # get destination
-            try:
-                dest = self.get_tree(new[:-1])
-            except ValueError:
-                if not said_nodest:
-                    guiutil.error(_('Can\'t copy to a non-existent '
-                                    'directory.'))
-                    said_nodest = True
-                failed.append(old)
-                cannot_copy.append(guiutil.printable_path(old))
-                continue
-            current_items = [k[0] for k in dest if k is not None]
-            current_items += [name for name, i in dest[None]]
+            dest_path = tuple(new[:-1])
+            if dest_path in dests:
+                dest, current_items = dests[dest_path]
+            else:
+                try:
+                    dest = self.get_tree(dest_path, own = True)
+                except ValueError:
+                    if not said_nodest:
+                        guiutil.error(_('Can\'t copy to a non-existent '
+                                        'directory.'))
+                        said_nodest = True
+                    failed.add(i)
+                    cannot_copy.append(guiutil.printable_path(old))
+                    continue
+                current_items = set(gcutil.tree_names(dest))
+                dests[dest_path] = (dest, current_items)
             is_dir = True
             # get source
             try:
                 # try to get dir
-                parent, (old[-1], index) = self.get_tree(old, True)
+                parent, old_k = self.get_tree(old, True)
             except ValueError:
                 # file instead
                 is_dir = False
                 try:
-                    parent, (old[-1], index) = self.get_file(old)
+                    parent, old_k = self.get_file(old)
                 except ValueError:
                     # been deleted or something
-                    failed.append(old)
+                    failed.add(i)
                     cannot_copy.append(guiutil.printable_path(old))
                     continue
             this_failed = False
             while True:
-                p_new = guiutil.printable_path(new)
                 if new[-1] in current_items:
                     # exists
+                    p_new = guiutil.printable_path(new)
                     action = guiutil.move_conflict(old[-1], p_new, self.editor)
                 elif guiutil.invalid_name(new[-1]):
+                    p_new = guiutil.printable_path(new)
                     action = guiutil.move_conflict(old[-1], p_new, self.editor,
                                                    True)
                 else:
@@ -500,86 +728,110 @@ Takes an argument indicating whether to import directories (else files).
                     else:
                         self.delete(new)
                         current_items.remove(new[-1])
+                        # forget destinations that might have been inside
+                        # what we just deleted
+                        dests = {dest_path: dests[dest_path]}
                 elif action:
                     new[-1] = action
                 else:
                     this_failed = True
                     break
             if this_failed:
-                failed.append(old)
+                failed.add(i)
             elif old != new:
                 # copy
+                new_k = (new[-1], old_k[1])
                 if is_dir:
-                    # copy tree so they can be modified independently
-                    dest[(new[-1], index)] = deepcopy(parent[(old[-1], index)])
+                    tree = parent[old_k]
+                    if new[:len(old)] == old:
+                        # into itself: sharing would make a loop
+                        tree = _copy_tree(tree)
+                    elif copy_trees:
+                        # share the tree until one of them is changed
+                        self._share(tree)
+                        # forget destinations that might be inside it
+                        dests = {dest_path: dests[dest_path]}
+                    dest[new_k] = tree
+                    self._count_added(new, new_k[1], tree)
                 else:
-                    dest[None].append((new[-1], index))
+                    dest[None].append(new_k)
+                    self._count_added(new, new_k[1])
+                current_items.add(new[-1])
         if cannot_copy:
             # show error for files that couldn't be copied
             v = guiutil.text_viewer('\n'.join(cannot_copy), gtk.WrapMode.NONE)
             guiutil.error(_('Couldn\'t copy some items:'), self.editor, v)
         # add to history
-        succeeded = [x for x in data if x[0] not in failed and x[0] != x[1]]
-        if succeeded:
-            if update_sizes:
-                self._update_sizes(*(new for old, new in succeeded))
-            if hist:
-                self._add_hist(('copy', succeeded))
+        succeeded = [x for i, x in enumerate(data)
+                     if i not in failed and x[0] != x[1]]
+        if succeeded and hist:
+            self._add_hist(('copy', succeeded))
         if return_failed:
             return failed
         else:
             return len(failed) != len(data)
 
-    def move (self, *data, hist = True, update_sizes = True):
+    def move (self, *data, hist = True):
+        # moving something to where it already is does nothing
+        data = [x for x in data if x[0] != x[1]]
+        if not data:
+            return True
+        # the sources are deleted afterwards, so directories can be moved
+        # without copying them (unless moving into themselves)
         failed = self.copy(*data, return_failed = True, hist = False,
-                           update_sizes = False)
+                           copy_trees = False)
         if len(failed) != len(data):
-            succeeded = [x for x in data if x[0] not in failed]
+            succeeded = [x for i, x in enumerate(data) if i not in failed]
             if succeeded:
-                self.delete(*(old for old, new in succeeded), hist = False,
-                            update_sizes = False)
+                self.delete(*(old for old, new in succeeded), hist = False)
                 # add to history
-                if update_sizes:
-                    self._update_sizes(*sum((tuple(x) for x in succeeded), ()))
                 if hist:
                     self._add_hist(('move', succeeded))
             return True
         else:
             return False
 
-    def delete (self, *files, hist = True, update_sizes = True):
+    def delete (self, *files, hist = True):
         done = []
+        # files to remove from each dir, as {id(dir): (dir, entries)}; each
+        # dir's file list is filtered once at the end
+        to_remove = {}
+        get_tree = self.get_tree
+        get_file = self.get_file
         for f in files:
             try:
                 # dir
-                parent, k = self.get_tree(f, True)
+                parent, k = get_tree(f, True, True)
             except ValueError:
                 # file
-                parent, entry = self.get_file(f)
-                parent[None].remove(entry)
+                parent, entry = get_file(f, True)
+                entries = to_remove.setdefault(id(parent), (parent, set()))[1]
+                if entry in entries:
+                    # given more than once
+                    continue
+                entries.add(entry)
                 done.append((f, entry))
+                tree = None
             else:
-                done.append((f, k, parent[k]))
-                del parent[k]
+                tree = parent.pop(k)
+                done.append((f, k, tree))
+            self._count_removed(f, tree)
+        for parent, entries in to_remove.values():
+            parent[None][:] = [e for e in parent[None] if e not in entries]
         # history
-        if done:
-            if update_sizes:
-                self._update_sizes(*(x[0] for x in done))
-            if hist:
-                self._add_hist(('delete', done))
+        if done and hist:
+            self._add_hist(('delete', done))
         return True
 
-    def new_dir (self, path, hist = True, update_sizes = True):
+    def new_dir (self, path, hist = True):
         *dest, name = path
         try:
-            dest = self.get_tree(dest)
+            dest = self.get_tree(dest, own = True)
         except ValueError:
             guiutil.error(_('Can\'t create a directory in a non-existent '
                             'directory.'))
             return False
-        current_items = [k[0] for k in dest if k is not None]
-        current_items += [name for name, i in dest[None]]
-        if name in current_items:
+        if name in gcutil.tree_names(dest):
             # already exists: show error
             path = guiutil.printable_path(path)
             msg = _('Directory \'{}\' already exists.')
@@ -590,9 +842,8 @@ Takes an argument indicating whether to import directories (else files).
                                           self.editor)
             return False
         else:
-            dest[(name, None)] = {None: []}
-            if update_sizes:
-                self._update_sizes(path)
+            dest[(name, None)] = tree = {None: []}
+            self._count_added(path, None, tree)
             if hist:
                 self._add_hist(('new', path))
             return True
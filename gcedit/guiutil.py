@@ -27,6 +27,7 @@ Progress
 
 from html import escape
 from math import log10
+from itertools import chain
 
 from gi.repository import Gtk as gtk, Pango as pango, Gdk as gdk
 from .ext.gcutil import valid_name
@@ -116,7 +117,7 @@ response: The index of the clicked button in the list, or a number less than 0
                           mt, gtk.ButtonsType.NONE, msg[0])
     if len(msg) >= 2:
         d.format_secondary_text(msg[1])
-    d.add_buttons(*(sum(((o, i) for i, o in enumerate(options)), ())))
+    d.add_buttons(*chain.from_iterable((o, i) for i, o in enumerate(options)))
     # FIXME: sets default to 0 if we don't set it here
     if default is not None:
         d.set_default_response(default)
@@ -413,8 +414,9 @@ parent: dialogue parent.
 
 def invalid_name (name):
     """Check if a filename is valid."""
-    if conf.INVALID_FN_CHARS[isinstance(name, str)].intersection(name):
-        return False
+    # substring tests, so this works for bytes as well as str
+    if any(c in name for c in conf.INVALID_FN_CHARS[isinstance(name, str)]):
+        return True
     else:
         return not valid_name(name)
 
@@ -0,0 +1,160 @@
+"""Tests for gcedit.fsbackend's changes to the tree and its caches."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gcedit.ext import gcutil
+try:
+    from gcedit import fsbackend
+except ImportError:
+    # needs GTK
+    fsbackend = None
+
+from test_gcutil import make_image, data
+
+
+class FileManager:
+    path = []
+
+    def refresh (self, *names):
+        pass
+
+
+class Editor:
+    """Enough of gcedit.editor.Editor for FSBackend."""
+
+    def __init__ (self):
+        self.file_manager = FileManager()
+
+    def hist_update (self):
+        pass
+
+
+def canon (tree):
+    """Get a tree's contents in a form that can be compared."""
+    return (sorted(tree[None]),
+            sorted((k, canon(child)) for k, child in tree.items()
+                   if k is not None))
+
+
+@unittest.skipIf(fsbackend is None, 'GTK is not available')
+class BackendTest (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp()
+        fn = os.path.join(self.tmp_dir, 'disk.iso')
+        make_image(fn, [('f0', 0x4000, data(0, 100)),
+                        ('f1', 0x4100, data(1, 200)),
+                        ('f2', 0x4200, data(2, 300))])
+        self.fs = fs = gcutil.GCFS(fn)
+        self.i = i = {name: i for (name, i), parent, tree_i, path
+                      in fs.flatten_tree(dirs = False)}
+        # a/b/f2, a/f1, f0
+        fs.tree = {None: [('f0', i['f0'])], ('a', None): {
+            None: [('f1', i['f1'])],
+            ('b', None): {None: [('f2', i['f2'])]}
+        }}
+        self.backend = fsbackend.FSBackend(fs, Editor())
+
+    def tearDown (self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_sizes (self):
+        """Check cached sizes against a full count of the tree."""
+        fs = self.fs
+        sizes = self.backend._sizes
+        self.assertEqual(sizes[()], fs.tree_size(fs.tree, True))
+        for tree, parent, k, path in fs.flatten_tree(files = False):
+            self.assertEqual(sizes[tuple(path + [k[0]])],
+                             fs.tree_size(tree, True))
+        for (name, i), parent, tree_i, path in fs.flatten_tree(dirs = False):
+            self.assertEqual(sizes[tuple(path + [name])], fs.entries[i][3])
+
+    def test_edit_copy (self):
+        # changing a copied directory leaves the original alone, and the
+        # other way around
+        backend = self.backend
+        get_tree = backend.get_tree
+        backend.copy((['a'], ['c']))
+        orig = canon(get_tree(['a']))
+        self.assertEqual(canon(get_tree(['c'])), orig)
+        backend.delete(['c', 'b', 'f2'])
+        backend.new_dir(['c', 'n'])
+        self.assertEqual(canon(get_tree(['a'])), orig)
+        self.assertEqual(canon(get_tree(['c'])), (
+            [('f1', self.i['f1'])],
+            [(('b', None), ([], [])), (('n', None), ([], []))]
+        ))
+        copy = canon(get_tree(['c']))
+        backend.move((['a', 'f1'], ['a', 'b', 'f1']))
+        self.assertEqual(canon(get_tree(['c'])), copy)
+        self.assertEqual(get_tree(['a'])[None], [])
+        self.check_sizes()
+
+    def test_move_copy (self):
+        # a moved directory is still shared with its copies
+        backend = self.backend
+        get_tree = backend.get_tree
+        backend.copy((['a'], ['c']))
+        backend.move((['a'], ['e']))
+        orig = canon(get_tree(['c']))
+        backend.delete(['e', 'f1'])
+        backend.new_dir(['e', 'b', 'n'])
+        self.assertEqual(canon(get_tree(['c'])), orig)
+        self.assertEqual(get_tree(['e'])[None], [])
+        self.assertEqual(canon(get_tree(['e', 'b']))[1],
+                         [(('n', None), ([], []))])
+        self.check_sizes()
+
+    def test_undo_redo_copy (self):
+        # undoing and redoing changes to a copy gives back the same trees
+        backend = self.backend
+        fs = self.fs
+        states = [canon(fs.tree)]
+        backend.copy((['a'], ['c']))
+        states.append(canon(fs.tree))
+        backend.delete(['c', 'b'])
+        states.append(canon(fs.tree))
+        backend.move((['a', 'b'], ['c', 'b']))
+        states.append(canon(fs.tree))
+        backend.new_dir(['a', 'b'])
+        states.append(canon(fs.tree))
+        for state in reversed(states[:-1]):
+            backend.undo()
+            self.assertEqual(canon(fs.tree), state)
+            self.check_sizes()
+        for state in states[1:]:
+            backend.redo()
+            self.assertEqual(canon(fs.tree), state)
+            self.check_sizes()
+        # the redone copy is still separate from the original
+        backend.delete(['c', 'f1'])
+        self.assertEqual(backend.get_tree(['a'])[None],
+                         [('f1', self.i['f1'])])
+        self.assertEqual(backend.get_tree(['c'])[None], [])
+
+    def test_sizes (self):
+        # cached sizes follow shared directories being added and removed
+        backend = self.backend
+        self.check_sizes()
+        backend.copy((['a'], ['c']), (['a', 'b'], ['d']))
+        self.check_sizes()
+        backend.copy((['c'], ['a', 'b', 'c']))
+        self.check_sizes()
+        backend.delete(['a', 'b', 'f2'])
+        self.check_sizes()
+        backend.delete(['c'])
+        self.check_sizes()
+        backend.move((['d'], ['a', 'd']))
+        self.check_sizes()
+        backend.undo()
+        backend.undo()
+        self.check_sizes()
+        backend.redo()
+        self.check_sizes()
+
+
+if __name__ == '__main__':
+    unittest.main()
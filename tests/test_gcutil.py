@@ -0,0 +1,333 @@
+"""Tests for gcedit.ext.gcutil, using small generated disk images."""
+
+import errno
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from gcedit.ext import gcutil
+
+FS_START = 0x2460
+
+
+def make_image (fn, files, size = None):
+    """Write a minimal disk image with the given files in its root directory.
+
+make_image(fn, files[, size])
+
+files: list of (name, start, data) tuples.
+size: size of the image; defaults to the end of the last file.
+
+"""
+    names = b''.join(name.encode('ascii') + b'\0'
+                     for name, start, data in files)
+    n = len(files) + 1
+    fst_size = n * 0xc + len(names)
+    if size is None:
+        size = max(start + len(data) for name, start, data in files)
+    img = bytearray(size)
+    img[0:4] = b'GTST'
+    img[0x1c:0x20] = struct.pack('>I', 0xc2339f3d)
+    img[0x20:0x30] = b'Test Game Name\0\0'
+    img[0x424:0x430] = struct.pack('>III', FS_START, fst_size, fst_size)
+    img[0x2440:0x244a] = b'2006/01/01'
+    fst = [struct.pack('>III', 0x01000000, 0, n)]
+    str_start = 0
+    for name, start, data in files:
+        fst.append(struct.pack('>III', str_start, start, len(data)))
+        str_start += len(name) + 1
+    fst = b''.join(fst) + names
+    img[FS_START:FS_START + len(fst)] = fst
+    for name, start, data in files:
+        img[start:start + len(data)] = data
+    with open(fn, 'wb') as f:
+        f.write(img)
+
+
+def data (seed, size):
+    """Get size bytes of data that differ for each seed."""
+    return bytes((seed * 7 + i * 13) % 251 for i in range(size))
+
+
+class GapsTest (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, 'disk.iso')
+
+    def tearDown (self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_files (self, fs, files):
+        """Check the files in the image have the given contents."""
+        got = {name: fs.read_file(i) for (name, i), parent, tree_i, path
+               in fs.flatten_tree(dirs = False)}
+        self.assertEqual(got, files)
+        # and the same after reloading
+        fs = gcutil.GCFS(self.fn)
+        got = {name: fs.read_file(i) for (name, i), parent, tree_i, path
+               in fs.flatten_tree(dirs = False)}
+        self.assertEqual(got, files)
+
+    def check_find (self, gaps, free):
+        """Check _Gaps.find against a search through the gaps in order."""
+        for size in range(0, max(size for start, size in free) + 2):
+            for before in (None, 0, 50, 100, 1000, 10000):
+                # the earliest gap big enough, if it starts before before
+                want = -1
+                for i, (start, gap_size) in enumerate(free):
+                    if gap_size > 0 and gap_size >= size:
+                        if before is None or start < before:
+                            want = i
+                        break
+                self.assertEqual(gaps.find(size, before), want,
+                                 (free, size, before))
+
+    def test_gaps_find (self):
+        # the first gap that's big enough, as long as it's before the file
+        rnd = random.Random(0)
+        for n in (1, 2, 3, 5, 8, 13):
+            start = 0
+            free = []
+            for i in range(n):
+                start += rnd.randrange(1, 500)
+                size = rnd.randrange(1, 100)
+                free.append((start, size))
+                start += size
+            self.check_find(gcutil._Gaps(free), free)
+        self.assertEqual(gcutil._Gaps([]).find(0), -1)
+
+    def test_gaps_equal_sizes (self):
+        # gaps of the same size are used in position order
+        free = [(100, 8), (200, 4), (300, 8), (400, 8)]
+        gaps = gcutil._Gaps(free)
+        self.assertEqual(gaps.find(8), 0)
+        self.assertEqual(gaps.find(5), 0)
+        gaps.set(0, 104, 4)
+        self.assertEqual(gaps.find(8), 2)
+        self.assertEqual(gaps.find(4), 0)
+        self.assertEqual(gaps.find(8, 300), -1)
+        self.assertEqual(gaps.find(8, 301), 2)
+
+    def test_gaps_set (self):
+        # shrinking gaps, down to nothing, as files are moved into them
+        rnd = random.Random(1)
+        free = [(i * 100, rnd.randrange(1, 60)) for i in range(1, 12)]
+        gaps = gcutil._Gaps(free)
+        while any(size for start, size in free):
+            i = rnd.choice([i for i, (start, size) in enumerate(free) if size])
+            start, size = free[i]
+            used = rnd.randrange(1, size + 1)
+            free[i] = (start + used, size - used)
+            gaps.set(i, *free[i])
+            self.assertEqual(gaps.gaps, free)
+            self.check_find(gaps, free)
+        # a gap shrunk to nothing is never found, even for empty files
+        self.assertEqual(gaps.find(0), -1)
+
+    def test_compress_empty_file_inside_file (self):
+        # empty files placed inside another file's data don't end that file
+        big = data(1, 70000)
+        last = data(2, 70000)
+        files = [('a0', 32432, big)]
+        files += [('e{}'.format(i), 32452, b'') for i in range(6)]
+        files.append(('last', 150400, last))
+        make_image(self.fn, files)
+        fs = gcutil.GCFS(self.fn)
+        self.assertFalse(fs.compress())
+        expected = {name: d for name, start, d in files}
+        self.check_files(fs, expected)
+        # the last file can only go straight after the first
+        self.assertEqual(os.path.getsize(self.fn), 102432 + 70000)
+        # no files overlap
+        used = sorted((start, start + size) for is_dir, str_start, start, size
+                      in fs.entries if size)
+        for (start, end), (next_start, next_end) in zip(used, used[1:]):
+            self.assertLessEqual(end, next_start)
+
+    def test_write_empty_file_inside_file (self):
+        # new files aren't put over data that an empty file is inside
+        big = data(1, 70000)
+        files = [('a0', 32432, big), ('e', 32452, b''),
+                 ('last', 150400, data(2, 1000))]
+        make_image(self.fn, files)
+        fs = gcutil.GCFS(self.fn)
+        new = os.path.join(self.tmp_dir, 'new')
+        new_data = data(3, 40000)
+        with open(new, 'wb') as f:
+            f.write(new_data)
+        fs.tree[None].append(('new', new))
+        self.assertFalse(fs.write())
+        expected = {name: d for name, start, d in files}
+        expected['new'] = new_data
+        self.check_files(fs, expected)
+
+    def test_write_merged_gap (self):
+        # gaps either side of an empty file are used as one
+        files = [('a', 0x4000, data(1, 0x100)), ('e', 0x4200, b''),
+                 ('b', 0x4300, data(2, 0x100))]
+        expected = {name: d for name, start, d in files}
+        for n_new in (1, 2):
+            make_image(self.fn, files)
+            fs = gcutil.GCFS(self.fn)
+            # the second file doesn't fit anywhere, so goes at the end
+            for i, size in enumerate((0x180, 0x2000)[:n_new]):
+                name = 'new{}'.format(i)
+                new = os.path.join(self.tmp_dir, name)
+                expected[name] = new_data = data(3 + i, size)
+                with open(new, 'wb') as f:
+                    f.write(new_data)
+                fs.tree[None].append((name, new))
+            self.assertFalse(fs.write())
+            self.check_files(fs, expected)
+            starts = {name: fs.entries[i][2] for (name, i), parent, tree_i,
+                      path in fs.flatten_tree(dirs = False)}
+            self.assertEqual(starts['new0'], 0x4100)
+            if n_new == 1:
+                self.assertEqual(os.path.getsize(self.fn), 0x4400)
+            else:
+                self.assertEqual(starts['new1'], 0x4400)
+
+
+@unittest.skipUnless(hasattr(os, 'preadv'),
+                     'sharing a file between threads needs positional I/O')
+class CopyTest (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # small blocks, so files take several each
+        patcher = mock.patch.object(gcutil, 'BLOCK_SIZE', 0x1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown (self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_copy (self, name, orig, moves, srcs, threads, **kw):
+        """Copy within and into an image, and return its new contents.
+
+run_copy(name, orig, moves, srcs, threads, **kw) -> (failed, data)
+
+name: filename in the temp dir for the image.
+orig: original data in the image.
+moves: (src_start, dest_start, size) tuples for moves within the image.
+srcs: (data, dest_start) tuples for files to copy into the image.
+kw: passed to copy.
+
+"""
+        fn = os.path.join(self.tmp_dir, name)
+        with open(fn, 'wb') as f:
+            f.write(orig)
+        files = []
+        for i, (d, dest_start) in enumerate(srcs):
+            src = os.path.join(self.tmp_dir, '{}-src{}'.format(name, i))
+            with open(src, 'wb') as f:
+                f.write(d)
+            files.append(((src, 0, len(d)), dest_start))
+        with open(fn, 'r+b') as f:
+            to_copy = [((f, src, size), (f, dest))
+                       for src, dest, size in moves]
+            to_copy += [(src, (f, dest)) for src, dest in files]
+            failed = gcutil.copy(to_copy, threads = threads, **kw)
+        with open(fn, 'rb') as f:
+            return failed, f.read()
+
+    def check_copy (self, all_threads = (1, 4), **kw):
+        """Check copies give the same data with one thread or several.
+
+check_copy(all_threads = (1, 4), **kw)
+
+all_threads: the numbers of threads to copy with.
+kw: passed to copy.
+
+"""
+        orig = data(1, 0x20000)
+        # file data moved earlier, overlapping its own old position, or to
+        # somewhere unused
+        moves = [(0x2100, 0x2000, 0x3000), (0x8000, 0x7800, 0x10),
+                 (0x9000, 0x10000, 0x2345), (0xc000, 0xc000, 0x100)]
+        self.assertTrue(gcutil._moves_independent(moves))
+        srcs = [(data(2, 0x1801), 0x14000), (data(3, 0x5000), 0x18000),
+                (b'', 0x1f000)]
+        expected = bytearray(orig)
+        for src, dest, size in moves:
+            expected[dest:dest + size] = orig[src:src + size]
+        for d, dest in srcs:
+            expected[dest:dest + len(d)] = d
+        for threads in all_threads:
+            failed, got = self.run_copy('image{}'.format(threads), orig,
+                                        moves, srcs, threads, **kw)
+            self.assertEqual(failed, [])
+            self.assertEqual(got, expected)
+
+    def test_threads (self):
+        self.check_copy()
+
+    def test_threads_progress (self):
+        # progress is shared between threads, so it only goes up
+        calls = []
+        def progress (done, total, name):
+            calls.append((done, total))
+        self.check_copy((4,), progress = progress, names = list(range(7)))
+        self.assertTrue(calls)
+        done = [d for d, total in calls]
+        self.assertEqual(done, sorted(done))
+        self.assertLessEqual(done[-1], calls[-1][1])
+
+    def test_threads_no_kernel_copy (self):
+        # falls back to copying through memory if the kernel can't copy
+        err = OSError(errno.EXDEV, 'cross-device')
+        with mock.patch.object(os, 'copy_file_range', side_effect = err,
+                               create = True) as copy_file_range:
+            self.check_copy()
+        self.assertTrue(copy_file_range.called)
+
+    def test_threads_cancel (self):
+        # cancelling from one thread stops the others
+        orig = data(1, 0x20000)
+        moves = [(0x10000 + i * 0x2000, i * 0x2000, 0x2000)
+                 for i in range(8)]
+        failed, got = self.run_copy('image', orig, moves, [], 4,
+                                    progress = lambda d, t, n: 2,
+                                    names = list(range(8)),
+                                    can_cancel = True)
+        self.assertIs(failed, True)
+        # no file finishes, so there's never a free thread to start the last
+        self.assertEqual(got[0xe000:0x10000], orig[0xe000:0x10000])
+
+    def test_moves_independent (self):
+        independent = gcutil._moves_independent
+        # moves over only their own sources are fine
+        self.assertTrue(independent([(100, 50, 100), (300, 250, 100)]))
+        self.assertTrue(independent([(100, 150, 100), (300, 200, 50)]))
+        # a move over another's source isn't
+        self.assertFalse(independent([(100, 50, 100), (300, 150, 100)]))
+        self.assertFalse(independent([(100, 250, 100), (300, 400, 100)]))
+        self.assertFalse(independent([(100, 299, 2), (300, 400, 100)]))
+        # touching isn't overlapping
+        self.assertTrue(independent([(100, 300, 100), (200, 0, 100)]))
+        # empty moves don't count
+        self.assertTrue(independent([(100, 0, 0), (0, 100, 50)]))
+        # overlapping sources
+        self.assertFalse(independent([(100, 0, 100), (150, 500, 100)]))
+
+
+class PrepareCopyTest (unittest.TestCase):
+
+    def test_fadvise_refused (self):
+        # the access hint is optional, so a filesystem refusing it is fine
+        err = OSError(errno.EINVAL, 'refused')
+        with tempfile.TemporaryFile() as f, \
+             mock.patch.object(os, 'posix_fadvise', side_effect = err,
+                               create = True):
+            f.write(b'x' * 10)
+            self.assertTrue(gcutil._prepare_copy(f, 100))
+            self.assertFalse(gcutil._prepare_copy(f, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+"""Tests for gcedit.guiutil's checks that don't need a display."""
+
+import unittest
+
+try:
+    from gcedit import guiutil
+except ImportError:
+    # needs GTK
+    guiutil = None
+
+
+@unittest.skipIf(guiutil is None, 'GTK is not available')
+class InvalidNameTest (unittest.TestCase):
+
+    def test_separator (self):
+        # names can't contain the path separator, as str or bytes
+        self.assertTrue(guiutil.invalid_name('a/b'))
+        self.assertTrue(guiutil.invalid_name(b'a/b'))
+        self.assertTrue(guiutil.invalid_name('/'))
+        self.assertTrue(guiutil.invalid_name(b'/'))
+
+    def test_valid (self):
+        self.assertFalse(guiutil.invalid_name('ab.bin'))
+        self.assertFalse(guiutil.invalid_name(b'ab.bin'))
+
+    def test_null (self):
+        self.assertTrue(guiutil.invalid_name('a\0b'))
+        self.assertTrue(guiutil.invalid_name(b'a\0b'))
+
+
+if __name__ == '__main__':
+    unittest.main()